@@ -0,0 +1,131 @@
+import contextvars
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, List
+from decouple import config
+from aerialist.px4.drone_test import DroneTest, DroneTestResult, AgentConfig
+
+AGENT = config("AGENT", default=AgentConfig.DOCKER)
+POOL_SIZE = config("POOL_SIZE", default=1, cast=int)
+# stand-in backend that follows the mission waypoints, no PX4 or Docker needed
+KINEMATIC = "kinematic"
+# simulations run by workers on other hosts, see distributed.py
+REMOTE = "remote"
+
+if AGENT == AgentConfig.LOCAL:
+    from aerialist.px4.local_agent import LocalAgent
+if AGENT == AgentConfig.DOCKER:
+    from aerialist.px4.docker_agent import DockerAgent
+if AGENT == AgentConfig.K8S:
+    from aerialist.px4.k8s_agent import K8sAgent
+
+logger = logging.getLogger(__name__)
+
+
+class AerialistBackend(object):
+    """Runs tests with Aerialist's agents. Aerialist's agents take the test in their constructor and set up
+    (and tear down) their own PX4 SITL instance or container for it, with no way to hand a running simulator
+    a second test. So an agent is created for every test, and these backends gain nothing from the pool
+    beyond running up to `size` simulations at once: each one still pays the full simulator startup"""
+
+    # the flight is only known once the mission is over, see run()
+    streams = False
+
+    def __init__(self, engine: str = AGENT):
+        self.engine = engine
+
+    def run(self, test: DroneTest, monitor=None) -> List[DroneTestResult]:
+        # Aerialist's agents hand back the flight log once the mission is over, so the monitor
+        # has nothing to follow and the flight is never aborted early
+        if self.engine == AgentConfig.LOCAL:
+            agent = LocalAgent(test)
+        if self.engine == AgentConfig.DOCKER:
+            agent = DockerAgent(test)
+        if self.engine == AgentConfig.K8S:
+            agent = K8sAgent(test)
+        return agent.run()
+
+
+def default_backend():
+    if AGENT == KINEMATIC:
+        from fake_simulator import KinematicSimulator
+        return KinematicSimulator()
+    if AGENT == REMOTE:
+        from distributed import RemoteBackend, get_coordinator
+        return RemoteBackend(get_coordinator())
+    return AerialistBackend(AGENT)
+
+
+class AgentPool(object):
+    """Long-lived simulation workers, each owning one backend, fed from a shared job queue. Only backends that
+    keep their simulator between tests (the kinematic and replay stand-ins) save on startup; with Aerialist's
+    agents the pool only bounds the number of concurrent simulations (see AerialistBackend)"""
+
+    def __init__(self, size: int = POOL_SIZE, backend_factory: Callable = default_backend):
+        self.size = size
+        self.jobs = queue.Queue()
+        self.workers = []
+        backends = [backend_factory() for i in range(size)]
+        # whether the backends follow the flight with an early-abort monitor while it runs
+        self.streams = all(getattr(backend, "streams", False) for backend in backends)
+        for i, backend in enumerate(backends):
+            worker = threading.Thread(target=self.work, args=(backend,), name=f"sim-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def work(self, backend):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            test, monitor, future, context = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                # in the submitter's log context, so the records say which iteration and node they belong to
+                if monitor is None:
+                    future.set_result(context.run(backend.run, test))
+                else:
+                    future.set_result(context.run(backend.run, test, monitor=monitor))
+            except Exception as e:
+                future.set_exception(e)
+
+    def submit(self, test: DroneTest, monitor=None) -> Future:
+        """Queue the test; a backend that streams the flight stops it once the monitor, if any, settles the outcome"""
+        future = Future()
+        self.jobs.put((test, monitor, future, contextvars.copy_context()))
+        return future
+
+    def run(self, test: DroneTest, monitor=None) -> List[DroneTestResult]:
+        """Run the test on the next free worker and wait for its results"""
+        return self.submit(test, monitor).result()
+
+    def close(self):
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def configure_pool(size: int = POOL_SIZE, backend_factory: Callable = default_backend) -> AgentPool:
+    """Replace the process-wide pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = AgentPool(size, backend_factory)
+    return _pool
+
+
+def get_pool() -> AgentPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = AgentPool()
+    return _pool
@@ -0,0 +1,143 @@
+import fcntl
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+from decouple import config
+from testcase import TestCase
+
+# what happens to the flight log and plot of a simulation that is not kept: delete, compress (gzip) or keep
+ARTEFACT_POLICY = config("ARTEFACT_POLICY", default="compress")
+# maximum size of an output folder in MB (0 = no quota)
+ARTEFACT_QUOTA_MB = config("ARTEFACT_QUOTA_MB", default=0, cast=float)
+
+# ioctl cloning a file's extents (reflink) on filesystems that support it (btrfs, xfs)
+FICLONE = 0x40049409
+
+logger = logging.getLogger(__name__)
+
+
+class DiskQuotaExceeded(Exception):
+    pass
+
+
+class ArtefactManager(object):
+    """Cleans up the artefacts of discarded simulations as soon as their reward is known, and exports the kept ones
+    with hardlinks or reflinks (byte copies only as a last resort), within a disk quota"""
+
+    def __init__(self, policy: str = ARTEFACT_POLICY, quota_mb: float = ARTEFACT_QUOTA_MB):
+        if policy not in ["delete", "compress", "keep"]:
+            raise ValueError(f"unknown artefact policy {policy}, expected delete, compress or keep")
+        self.policy = policy
+        self.quota = int(quota_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.usage = {}
+        self.discarded = 0
+        self.freed = 0
+
+    def discard(self, test_case: TestCase):
+        """Delete or compress the flight log and plot of a simulation that is not kept"""
+        if self.policy == "keep" or test_case.cached:
+            # cached results are shared with earlier simulations, which may have been kept
+            return
+        for path in [test_case.log_file, test_case.plot_file]:
+            if path is None or not os.path.isfile(path):
+                continue
+            size = os.path.getsize(path)
+            try:
+                if self.policy == "compress":
+                    with open(path, "rb") as source, gzip.open(f"{path}.gz", "wb") as target:
+                        shutil.copyfileobj(source, target)
+                    size -= os.path.getsize(f"{path}.gz")
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"could not {self.policy} {path}: {e}")
+                continue
+            with self.lock:
+                self.discarded += 1
+                self.freed += size
+
+    def export(self, source: str, target: str) -> int:
+        """Place source at target without copying its bytes if the filesystem allows it; return its size"""
+        size = os.path.getsize(source)
+        self.reserve(os.path.dirname(os.path.abspath(target)), size)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(source, target)
+            return size
+        except OSError:
+            pass
+        try:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return size
+        except OSError:
+            pass
+        shutil.copy2(source, target)
+        return size
+
+    def reserve(self, folder: str, size: int):
+        """Account size bytes to the folder, or raise DiskQuotaExceeded"""
+        # one account per folder, however the caller spells its path
+        folder = os.path.abspath(folder)
+        with self.lock:
+            used = self.usage.get(folder, 0)
+            if self.quota > 0 and used + size > self.quota:
+                raise DiskQuotaExceeded(
+                    f"{folder} would grow to {(used + size) / 2 ** 20:.2f} MB, above the quota of {self.quota / 2 ** 20:.2f} MB "
+                    f"(ARTEFACT_QUOTA_MB / --quota); raise the quota or move the previous results away")
+            free = shutil.disk_usage(folder).free
+            if size > free:
+                raise DiskQuotaExceeded(f"no space left for {size / 2 ** 20:.1f} MB in {folder} ({free / 2 ** 20:.1f} MB free)")
+            self.usage[folder] = used + size
+
+    def stats(self) -> dict:
+        return {"policy": self.policy, "discarded": self.discarded, "freed_bytes": self.freed}
+
+
+class Manifest(object):
+    """Index of an output folder, rewritten (atomically) after every change: manifest.json"""
+
+    def __init__(self, folder: str):
+        self.path = os.path.join(folder, "manifest.json")
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def add(self, entry: dict):
+        with self.lock:
+            self.entries.append(entry)
+            self.write()
+
+    def update(self, test: str, **fields):
+        with self.lock:
+            for entry in self.entries:
+                if entry["test"] == test:
+                    entry.update(fields)
+            self.write()
+
+    def write(self):
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def configure_artefacts(policy: str = ARTEFACT_POLICY, quota_mb: float = ARTEFACT_QUOTA_MB) -> ArtefactManager:
+    global _manager
+    with _manager_lock:
+        _manager = ArtefactManager(policy, quota_mb)
+    return _manager
+
+
+def get_artefacts() -> ArtefactManager:
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = ArtefactManager()
+    return _manager
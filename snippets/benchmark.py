@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+"""Benchmarks of the test generation overhead (everything but the simulation), driven by the
+deterministic kinematic stand-in simulator so that runs are reproducible without PX4.
+Results are compared against a stored baseline; --save-baseline records a new one."""
+import os
+
+# the stand-in simulator, no cache and no plots; must be set before the generator modules are imported
+os.environ["AGENT"] = "kinematic"
+os.environ["CACHE_FILE"] = ""
+os.environ["PLOTS"] = "none"
+
+from argparse import ArgumentParser
+import json
+import random
+import sys
+import time
+import tracemalloc
+import numpy as np
+import geometry
+from agent_pool import configure_pool
+from fake_simulator import KinematicSimulator
+from mcts import MCTS
+
+MISSIONS = ["case_studies/mission1.yaml", "case_studies/mission2.yaml", "case_studies/mission3.yaml"]
+BASELINE_FILE = "benchmark_baseline.json"
+# metrics where more is better, all the others are times or sizes
+HIGHER_IS_BETTER = ["search_iterations_per_second", "free_radii_per_second", "clearance_rows_per_second"]
+
+
+def seed(value: int):
+    random.seed(value)
+    np.random.seed(value)
+
+
+def bench_search(mission: str, budget: int) -> dict:
+    """Search throughput and memory per tree node"""
+    generator = MCTS(mission)
+    tracemalloc.start()
+    start = time.perf_counter()
+    generator.generate(budget)
+    seconds = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {
+        "search_iterations_per_second": budget / seconds,
+        "memory_per_node_bytes": memory / generator.tree_size,
+    }
+
+
+def bench_expansion(mission: str, repeats: int) -> dict:
+    """Mean latency of adding an obstacle to the simulated root and of modifying a child"""
+    generator = MCTS(mission)
+    generator.generate(0)
+    state = generator.root.state
+    start = time.perf_counter()
+    for i in range(repeats):
+        child = state.next_state()
+    next_state = (time.perf_counter() - start) / repeats
+    child.get_reward()
+    start = time.perf_counter()
+    for i in range(repeats):
+        child.modify_state()
+    modify_state = (time.perf_counter() - start) / repeats
+    return {"next_state_seconds": next_state, "modify_state_seconds": modify_state}
+
+
+def bench_geometry(repeats: int) -> dict:
+    """Throughput of the batched placement and clearance kernels"""
+    centers = np.random.uniform([-40, 10], [30, 40], (1000, 2))
+    rectangles = [(0, 20, 10, 5, 30), (-20, 30, 4, 8, 0), (10, 35, 6, 6, 75)]
+    bounds = (40, 10, -40, 30)
+    start = time.perf_counter()
+    for i in range(repeats):
+        geometry.free_radii(centers, bounds, rectangles)
+    free_radii = len(centers) * repeats / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for i in range(repeats):
+        geometry.clearance_matrix(centers, rectangles)
+    clearance = len(centers) * repeats / (time.perf_counter() - start)
+    return {"free_radii_per_second": free_radii, "clearance_rows_per_second": clearance}
+
+
+def bench_first_failure(mission: str, budget: int) -> dict:
+    """Time and iterations until the first hard failure (min distance < 0.25 m)"""
+    generator = MCTS(mission)
+    start = time.perf_counter()
+    for test_case in generator.iter_generate(budget):
+        if min(test_case.get_distances()) < 0.25:
+            return {"first_failure_seconds": time.perf_counter() - start, "first_failure_iterations": generator.iterations}
+    return {"first_failure_seconds": None, "first_failure_iterations": None}
+
+
+def run(budget: int, repeats: int, seed_value: int) -> dict:
+    configure_pool(1, KinematicSimulator)
+    results = {}
+    for mission in MISSIONS:
+        name = os.path.splitext(os.path.basename(mission))[0]
+        results[name] = {}
+        for bench in [lambda: bench_search(mission, budget), lambda: bench_expansion(mission, repeats),
+                      lambda: bench_first_failure(mission, budget)]:
+            seed(seed_value)
+            results[name].update(bench())
+    seed(seed_value)
+    results["geometry"] = bench_geometry(repeats)
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Metrics that are worse than the baseline by more than tolerance (a fraction)"""
+    regressions = []
+    for group, metrics in baseline.items():
+        for metric, expected in metrics.items():
+            actual = results.get(group, {}).get(metric)
+            if expected is None or actual is None:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                worse = actual < expected * (1 - tolerance)
+            else:
+                worse = actual > expected * (1 + tolerance)
+            if worse:
+                regressions.append(f"{group}.{metric}: {actual:.6g} (baseline {expected:.6g})")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="UAV test generator benchmarks")
+    parser.add_argument("--budget", type=int, default=50, help="search iterations per mission")
+    parser.add_argument("--repeats", type=int, default=200, help="repetitions of the micro benchmarks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    args = parser.parse_args()
+
+    results = run(args.budget, args.repeats, args.seed)
+    print(json.dumps(results, indent=2))
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline saved: {args.baseline}")
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        sys.exit(1 if len(regressions) != 0 else 0)
+    else:
+        print(f"no baseline at {args.baseline}, run with --save-baseline to record one")
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List
+from decouple import config
+from aerialist.px4.drone_test import DroneTest
+from aerialist.px4.obstacle import Obstacle
+from aerialist.px4.position import Position
+from aerialist.px4.trajectory import Trajectory
+
+CACHE_FILE = config("CACHE_FILE", default="./cache/simulations.sqlite")
+CACHE_SIZE = config("CACHE_SIZE", default=5000, cast=int)
+CACHE_PRECISION = config("CACHE_PRECISION", default=2, cast=int)
+
+logger = logging.getLogger(__name__)
+
+
+def canonical_obstacle(obstacle: Obstacle, precision: int = CACHE_PRECISION) -> tuple:
+    """Rounded (x, y, z, l, w, h, r) of an obstacle, with the rotation folded into [0, 90):
+    a rectangle rotated by r + 90 is the same rectangle with l and w swapped"""
+    l, w, r = obstacle.size.l, obstacle.size.w, obstacle.position.r % 180
+    if r >= 90:
+        l, w, r = w, l, r - 90
+    r = round(r, precision)
+    if r >= 90:
+        l, w, r = w, l, r - 90
+    values = (obstacle.position.x, obstacle.position.y, obstacle.position.z, l, w, obstacle.size.h, r)
+    # adding 0.0 turns -0.0 into 0.0
+    return tuple(round(v, precision) + 0.0 for v in values)
+
+
+def canonical_scenario(obstacles: List[Obstacle], precision: int = CACHE_PRECISION) -> tuple:
+    """Order-independent encoding of an obstacle set"""
+    return tuple(sorted(canonical_obstacle(obst, precision) for obst in obstacles))
+
+
+def canonical_order(obstacles: List[Obstacle], precision: int = CACHE_PRECISION) -> List[int]:
+    """Indices of the obstacles in the order of canonical_scenario"""
+    keys = [canonical_obstacle(obst, precision) for obst in obstacles]
+    return sorted(range(len(keys)), key=lambda i: keys[i])
+
+
+def mission_fingerprint(test: DroneTest) -> str:
+    """Hash of everything except the obstacles that affects the flight"""
+    digest = hashlib.sha1()
+    for path in [test.drone.mission_file, getattr(test.drone, "params_file", None), getattr(test.test, "commands_file", None)]:
+        if path is not None and os.path.isfile(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        digest.update(str(path).encode())
+    for setting in ["simulator", "speed", "home_position"]:
+        digest.update(str(getattr(test.simulation, setting, None)).encode())
+    return digest.hexdigest()
+
+
+def trajectory_to_list(trajectory: Trajectory) -> List[list]:
+    return [[p.x, p.y, p.z, p.r, p.timestamp] for p in trajectory.positions]
+
+
+def trajectory_from_list(positions: List[list]) -> Trajectory:
+    return Trajectory([Position(x=x, y=y, z=z, r=r, timestamp=t) for x, y, z, r, t in positions])
+
+
+class CacheEntry(object):
+    def __init__(self, trajectory: Trajectory, distances: List[float], log_file: str, plot_file: str):
+        self.trajectory = trajectory
+        self.distances = distances
+        self.log_file = log_file
+        self.plot_file = plot_file
+
+
+class SimulationCache(object):
+    """Disk-backed LRU cache of simulation results, keyed by the mission and the canonical obstacle set"""
+
+    def __init__(self, path: str, max_entries: int = CACHE_SIZE, precision: int = CACHE_PRECISION):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.precision = precision
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS simulations ("
+            "key TEXT PRIMARY KEY, trajectory TEXT, distances TEXT, log_file TEXT, plot_file TEXT, accessed REAL)"
+        )
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] < 1:
+            # distances of older caches are in the obstacle order of the first run; recomputed on the next hit
+            self.connection.execute("UPDATE simulations SET distances = NULL")
+            self.connection.execute("PRAGMA user_version = 1")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, test: DroneTest) -> str:
+        scenario = canonical_scenario(test.simulation.obstacles or [], self.precision)
+        return hashlib.sha1((mission_fingerprint(test) + json.dumps(scenario)).encode()).hexdigest()
+
+    def get(self, test: DroneTest, count: bool = True):
+        """The entry of the test, or None; without count, the lookup is left out of the hit/miss statistics
+        (reloading a flight that was evicted from memory is not a simulation saved)"""
+        key = self.key(test)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT trajectory, distances, log_file, plot_file FROM simulations WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                if count:
+                    self.misses += 1
+                return None
+            if count:
+                self.hits += 1
+            self.connection.execute("UPDATE simulations SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+        trajectory, distances, log_file, plot_file = row
+        if count:
+            logger.info(f"simulation cache hit: {key}")
+        if distances is not None:
+            # stored in canonical order, handed back in the order of this test's obstacles
+            canonical = json.loads(distances)
+            distances = [0.0] * len(canonical)
+            for position, index in enumerate(canonical_order(test.simulation.obstacles or [], self.precision)):
+                distances[index] = canonical[position]
+        return CacheEntry(
+            trajectory_from_list(json.loads(trajectory)),
+            distances,
+            log_file if log_file is not None and os.path.isfile(log_file) else None,
+            plot_file if plot_file is not None and os.path.isfile(plot_file) else None,
+        )
+
+    def put(self, test: DroneTest, trajectory: Trajectory, log_file: str):
+        key = self.key(test)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO simulations (key, trajectory, distances, log_file, plot_file, accessed) "
+                "VALUES (?, ?, NULL, ?, NULL, ?)",
+                (key, json.dumps(trajectory_to_list(trajectory)), log_file, time.time()),
+            )
+            self.evict()
+            self.connection.commit()
+
+    def update(self, test: DroneTest, distances: List[float] = None, plot_file: str = None):
+        """Attach the results computed after the simulation to an existing entry"""
+        key = self.key(test)
+        with self.lock:
+            if distances is not None:
+                # the key does not depend on the obstacle order, so neither may the stored distances
+                order = canonical_order(test.simulation.obstacles or [], self.precision)
+                self.connection.execute("UPDATE simulations SET distances = ? WHERE key = ?",
+                                        (json.dumps([distances[i] for i in order]), key))
+            if plot_file is not None:
+                self.connection.execute("UPDATE simulations SET plot_file = ? WHERE key = ?", (plot_file, key))
+            self.connection.commit()
+
+    def evict(self):
+        """Drop the least recently used entries above max_entries"""
+        size = self.connection.execute("SELECT COUNT(*) FROM simulations").fetchone()[0]
+        if size > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM simulations WHERE key IN (SELECT key FROM simulations ORDER BY accessed LIMIT ?)",
+                (size - self.max_entries,),
+            )
+            self.evictions += size - self.max_entries
+
+    def stats(self) -> dict:
+        with self.lock:
+            size = self.connection.execute("SELECT COUNT(*) FROM simulations").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups != 0 else 0.0,
+            "evictions": self.evictions,
+            "size": size,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Process-wide cache, or None if CACHE_FILE is empty"""
+    global _cache
+    with _cache_lock:
+        if _cache is None and CACHE_FILE:
+            _cache = SimulationCache(CACHE_FILE)
+    return _cache
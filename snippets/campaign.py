@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from mcts import MCTS
+from plotting import PlotRenderer
+from random_generator import RandomGenerator
+from rng import seed_thread
+from sink import OutputSink
+
+logger = logging.getLogger(__name__)
+
+GENERATORS = ["mcts", "random"]
+
+
+class CampaignJob(object):
+    """One (mission, seed, budget, generator) entry of a campaign manifest"""
+
+    def __init__(self, mission: str, budget: int, seed: int = 0, generator: str = "mcts", name: str = None):
+        if generator not in GENERATORS:
+            raise ValueError(f"unknown generator {generator}, expected one of {GENERATORS}")
+        self.mission = mission
+        self.budget = budget
+        self.seed = seed
+        self.generator = generator
+        self.name = name if name is not None else \
+            f"{os.path.splitext(os.path.basename(mission))[0]}-{generator}-seed{seed}"
+        self.status = "queued"
+        self.iterations = 0
+        self.test_cases = 0
+        self.seconds = 0.0
+        self.error = None
+
+    def progress(self) -> dict:
+        return {
+            "mission": self.mission,
+            "generator": self.generator,
+            "seed": self.seed,
+            "budget": self.budget,
+            "status": self.status,
+            "iterations": self.iterations,
+            "test_cases": self.test_cases,
+            "seconds": round(self.seconds, 1),
+            "error": self.error,
+        }
+
+
+class Campaign(object):
+    """Runs all the jobs of a manifest at once over the shared simulation pool (see agent_pool), so the
+    simulators stay busy until the last job ends. Every job keeps up to `workers` simulations queued;
+    the pool serves its queue in order, so the jobs take turns. Each job writes its test cases to its
+    own subfolder, and the progress of all jobs is kept up to date in progress.json.
+    Every job draws from its own random streams (see rng), seeded with the job's seed, so a (mission, seed)
+    job explores the same way whatever runs next to it"""
+
+    def __init__(self, jobs: List[CampaignJob], folder: str, workers: int = 1, renderer: PlotRenderer = None):
+        self.jobs = jobs
+        self.folder = folder
+        self.workers = workers
+        self.renderer = renderer if renderer is not None else PlotRenderer()
+        self.lock = threading.Lock()
+        names = [job.name for job in jobs]
+        if len(set(names)) != len(names):
+            raise ValueError(f"campaign jobs need distinct names (output folders): {names}")
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def load(manifest_file: str) -> List[CampaignJob]:
+        """The manifest is a JSON list of {"mission", "budget", "seed", "generator", "name"} objects
+        (seed, generator and name are optional)"""
+        with open(manifest_file) as f:
+            return [CampaignJob(**entry) for entry in json.load(f)]
+
+    def run(self) -> int:
+        """Run all the jobs and return the number of test cases found"""
+        with ThreadPoolExecutor(max_workers=len(self.jobs), thread_name_prefix="campaign") as executor:
+            for job in self.jobs:
+                executor.submit(self.run_job, job)
+        # the sinks share the renderer, so its plots are only waited for once every job is done
+        self.renderer.finish()
+        self.write_progress()
+        return sum(job.test_cases for job in self.jobs)
+
+    def run_job(self, job: CampaignJob):
+        start = time.perf_counter()
+        job.status = "running"
+        self.write_progress()
+        folder = f"{self.folder}{job.name}/"
+        try:
+            seed_thread(job.seed)
+            if job.generator == "mcts":
+                generator = MCTS(job.mission, workers=self.workers, checkpoint=f"{folder}checkpoint.jsonl")
+            else:
+                generator = RandomGenerator(job.mission, batch_size=1000, workers=self.workers)
+            sink = OutputSink(folder, self.renderer)
+            for test_case in generator.iter_generate(job.budget):
+                sink.write(test_case)
+                job.test_cases = sink.count
+                job.iterations = getattr(generator, "iterations", job.iterations)
+                job.seconds = time.perf_counter() - start
+                self.write_progress()
+            job.iterations = getattr(generator, "iterations", job.budget)
+            job.status = "done"
+        except Exception as e:
+            logger.exception(f"campaign job {job.name} failed")
+            job.status = "failed"
+            job.error = str(e)
+        job.seconds = time.perf_counter() - start
+        logger.info(f"campaign job {job.name} {job.status}: {job.test_cases} test cases in {job.seconds:.0f}s")
+        self.write_progress()
+
+    def write_progress(self):
+        with self.lock:
+            progress = {job.name: job.progress() for job in self.jobs}
+            with open(f"{self.folder}progress.json.tmp", "w") as f:
+                json.dump(progress, f, indent=2)
+            os.replace(f"{self.folder}progress.json.tmp", f"{self.folder}progress.json")
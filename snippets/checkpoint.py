@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+from typing import List, Sequence
+from aerialist.px4.obstacle import Obstacle
+from cache import trajectory_to_list, trajectory_from_list
+from rng import rng
+
+logger = logging.getLogger(__name__)
+
+
+def obstacle_to_list(obstacle: Obstacle) -> list:
+    return [obstacle.position.x, obstacle.position.y, obstacle.position.z,
+            obstacle.size.l, obstacle.size.w, obstacle.size.h, obstacle.position.r]
+
+
+def obstacle_from_list(values: Sequence[float]) -> Obstacle:
+    x, y, z, l, w, h, r = values
+    return Obstacle(Obstacle.Size(l=l, w=w, h=h), Obstacle.Position(x=x, y=y, z=z, r=r))
+
+
+def rng_state_to_list(state) -> list:
+    version, internal, gauss = state
+    return [version, list(internal), gauss]
+
+
+def rng_state_from_list(state: list):
+    version, internal, gauss = state
+    return version, tuple(internal), gauss
+
+
+class CheckpointJournal(object):
+    """Append-only JSONL journal of a search: one record per finished simulation, holding
+    everything needed to rebuild the tree (and the random state) without re-simulating"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        truncated = False
+        if os.path.isfile(path) and os.path.getsize(path) != 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                truncated = f.read(1) != b"\n"
+        self.file = open(path, "a")
+        if truncated:
+            self.file.write("\n")
+
+    def write(self, record: dict):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def record_simulation(self, node, parent_id, iterations: int, count: int, reward, min_distance, test_case):
+        state = node.state
+        self.write({
+            "node": node.id,
+            "parent": parent_id,
+            "scenario": [obstacle_to_list(obst) for obst in state.scenario],
+            "reward": reward,
+            "min_distance": min_distance,
+            "trajectory": trajectory_to_list(state.trajectory) if state.trajectory is not None else None,
+            "log_file": getattr(test_case, "log_file", None),
+            "plot_file": getattr(test_case, "plot_file", None),
+            "iterations": iterations,
+            "count": count,
+            "rng": rng_state_to_list(rng().getstate()),
+        })
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def load(path: str) -> List[dict]:
+        records = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the run died while writing the last record
+                    logger.warning(f"ignoring a truncated record in {path}")
+        return records
+
+    @staticmethod
+    def restore_rng(record: dict):
+        rng().setstate(rng_state_from_list(record["rng"]))
+
+    @staticmethod
+    def scenario(record: dict) -> List[Obstacle]:
+        return [obstacle_from_list(values) for values in record["scenario"]]
+
+    @staticmethod
+    def trajectory(record: dict):
+        return trajectory_from_list(record["trajectory"]) if record["trajectory"] is not None else None
@@ -2,12 +2,20 @@
 from argparse import ArgumentParser
 from datetime import datetime
 import logging
-import os
-import shutil
 import sys
 from decouple import config
 # from random_generator import RandomGenerator
 from mcts import MCTS
+from agent_pool import configure_pool
+from artefacts import ARTEFACT_POLICY, ARTEFACT_QUOTA_MB, configure_artefacts
+from cache import get_cache
+from campaign import Campaign
+from log_pipeline import configure_logging
+from plotting import PLOTS, PlotRenderer
+from sink import OutputSink
+from telemetry import TELEMETRY_FILE, telemetry
+from testcase import STAND_IN_EARLY_ABORT, TestCase
+from trajectory_store import TREE_MEMORY_MB
 
 TESTS_FOLDER = config("TESTS_FOLDER", default="./generated_tests/")
 logger = logging.getLogger(__name__)
@@ -17,8 +25,37 @@ def arg_parse():
     main_parser = ArgumentParser(
         description="UAV Test Generator",
     )
+    # options of both commands
+    common = ArgumentParser(add_help=False)
+    common.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of simulations to run concurrently, shared by all the jobs of a campaign (requires the docker, "
+             "k8s or kinematic agent); Aerialist's agents still start a new simulator for every test",
+    )
+    common.add_argument(
+        "--plots",
+        choices=["async", "end", "none"],
+        default=PLOTS,
+        help="render the plots of kept test cases in the background, after the run, or not at all",
+    )
+    common.add_argument(
+        "--artefacts",
+        choices=["delete", "compress", "keep"],
+        default=ARTEFACT_POLICY,
+        help="what to do with the flight logs and plots of simulations that are not kept",
+    )
+    common.add_argument(
+        "--quota",
+        type=float,
+        default=ARTEFACT_QUOTA_MB,
+        help="maximum size of an output folder in MB, the run stops with an error above it (0 = no quota)",
+    )
+
     subparsers = main_parser.add_subparsers()
-    parser = subparsers.add_parser(name="generate", description="generate tests")
+    parser = subparsers.add_parser(name="generate", description="generate tests", parents=[common])
+    parser.set_defaults(command="generate")
     parser.add_argument("test", help="initial test description file address")
 
     parser.add_argument(
@@ -26,51 +63,151 @@ def arg_parse():
         type=int,
         help="test generation budget (total number of simulations allowed)",
     )
+    parser.add_argument(
+        "--surrogate-threshold",
+        type=float,
+        default=None,
+        help="skip expansions whose predicted min distance (from the parent's trajectory) is above this, in meters",
+    )
+    parser.add_argument(
+        "--duplicate-tolerance",
+        type=float,
+        default=0.2,
+        help="skip scenarios whose obstacles all lie within this many meters (and 5 degrees) of a simulated one; negative disables",
+    )
+    parser.add_argument(
+        "--screen-speed",
+        type=float,
+        default=None,
+        help="screen candidates at this simulation speed and re-fly promising ones at speed 1",
+    )
+    parser.add_argument(
+        "--confirm-threshold",
+        type=float,
+        default=1.5,
+        help="screened min distance (meters) under which a candidate is re-flown at speed 1",
+    )
+    parser.add_argument(
+        "--confirm-budget",
+        type=int,
+        default=50,
+        help="number of full-fidelity confirmation simulations allowed, on top of the budget",
+    )
+    parser.add_argument(
+        "--stand-in-early-abort",
+        dest="early_abort",
+        action="store_true",
+        default=STAND_IN_EARLY_ABORT,
+        help="with the kinematic stand-in agent only: stop simulations once the drone hit an obstacle's 0.25 m zone, "
+             "or passed all the obstacles of a full-depth scenario. PX4 agents (local, docker, k8s) and remote "
+             "workers always fly the whole mission, and the option is ignored with a warning",
+    )
+    parser.add_argument(
+        "--refine-budget",
+        type=int,
+        default=0,
+        help="iterations, out of the budget, spent at the end on a local search around the closest near-misses",
+    )
+    parser.add_argument(
+        "--memory-cap",
+        type=float,
+        default=TREE_MEMORY_MB,
+        help="MB of trajectories of terminal and pruned nodes kept in memory, the rest is reloaded when needed (0 = no cap)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=f'logs/checkpoint-{datetime.now().strftime("%d-%m-%H-%M-%S")}.jsonl',
+        help="journal file every finished simulation is appended to",
+    )
+    parser.add_argument(
+        "--telemetry",
+        default=TELEMETRY_FILE,
+        help="JSONL file for per-iteration timing and counter events (disabled if empty)",
+    )
+    parser.add_argument(
+        "--resume",
+        default=None,
+        help="continue the search recorded in this checkpoint journal (and keep appending to it)",
+    )
+
+    campaign_parser = subparsers.add_parser(name="campaign", description="run many generation jobs over one worker pool",
+                                            parents=[common])
+    campaign_parser.set_defaults(command="campaign")
+    campaign_parser.add_argument(
+        "manifest",
+        help="JSON list of jobs: {\"mission\": yaml file, \"budget\": int, \"seed\": int, \"generator\": mcts|random}",
+    )
 
     args = main_parser.parse_args()
+    if getattr(args, "command", None) is None:
+        main_parser.error("a command is required: generate or campaign")
     return args
 
 
 def config_loggers():
-    os.makedirs("logs/", exist_ok=True)
-    logging.basicConfig(
-        level=logging.DEBUG,
-        filename="logs/debug.txt",
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    # terminal, logs/info.txt and logs/debug.txt, written by a background listener
+    configure_logging("logs/")
+
+
+def generate(args):
+    pool = configure_pool(args.workers)
+    configure_artefacts(args.artefacts, args.quota)
+    if args.early_abort and not pool.streams:
+        logger.warning("--stand-in-early-abort is ignored: the simulation backend (AGENT) only returns the flight "
+                       "once it is over, only the kinematic stand-in can be stopped early")
+    TestCase.early_abort = args.early_abort and pool.streams
+    if args.telemetry:
+        telemetry.enable(args.telemetry)
+    generator = MCTS(
+        case_study_file=args.test,
+        workers=args.workers,
+        surrogate_threshold=args.surrogate_threshold,
+        duplicate_tolerance=args.duplicate_tolerance if args.duplicate_tolerance >= 0 else None,
+        memory_cap=args.memory_cap,
+        screen_speed=args.screen_speed,
+        confirm_threshold=args.confirm_threshold,
+        confirm_budget=args.confirm_budget,
+        checkpoint=args.resume if args.resume is not None else args.checkpoint,
+        refine_budget=args.refine_budget,
     )
+    if args.resume is not None:
+        generator.resume(args.resume)
+
+    ### writing the test cases to the output folder as soon as they are found
+    tests_fld = f'{TESTS_FOLDER}{datetime.now().strftime("%d-%m-%H-%M-%S")}/'
+    sink = OutputSink(tests_fld, PlotRenderer(args.plots))
+    for test_case in generator.test_cases:
+        sink.write(test_case)
+    for test_case in generator.iter_generate(args.budget):
+        sink.write(test_case)
+    sink.close()
+
+    if get_cache() is not None:
+        logger.info(f"simulation cache: {get_cache().stats()}")
+    print(f"{sink.count} test cases generated")
+    print(f"output folder: {tests_fld}")
 
-    root = logging.getLogger()
-    # terminal logs
-    c_handler = logging.StreamHandler()
-    c_handler.setLevel(logging.INFO)
-    c_format = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
-    c_handler.setFormatter(c_format)
-    root.addHandler(c_handler)
 
-    # file logs
-    f_handler = logging.FileHandler("logs/info.txt")
-    f_handler.setLevel(logging.INFO)
-    f_format = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    f_handler.setFormatter(f_format)
-    root.addHandler(f_handler)
+def campaign(args):
+    configure_pool(args.workers)
+    configure_artefacts(args.artefacts, args.quota)
+    jobs = Campaign.load(args.manifest)
+    campaign_fld = f'{TESTS_FOLDER}campaign-{datetime.now().strftime("%d-%m-%H-%M-%S")}/'
+    count = Campaign(jobs, campaign_fld, args.workers, PlotRenderer(args.plots)).run()
+    if get_cache() is not None:
+        logger.info(f"simulation cache: {get_cache().stats()}")
+    print(f"{count} test cases generated by {len(jobs)} jobs")
+    print(f"output folder: {campaign_fld}")
 
 
 if __name__ == "__main__":
     config_loggers()
     try:
         args = arg_parse()
-        generator = MCTS(case_study_file=args.test)
-        test_cases = generator.generate(args.budget)
-
-        ### copying the test cases to the output folder
-        tests_fld = f'{TESTS_FOLDER}{datetime.now().strftime("%d-%m-%H-%M-%S")}/'
-        os.mkdir(tests_fld)
-        for i in range(len(test_cases)):
-            test_cases[i].save_yaml(f"{tests_fld}/test_{i}.yaml")
-            shutil.copy2(test_cases[i].log_file, f"{tests_fld}/test_{i}.ulg")
-            shutil.copy2(test_cases[i].plot_file, f"{tests_fld}/test_{i}.png")
-        print(f"{len(test_cases)} test cases generated")
-        print(f"output folder: {tests_fld}")
+        if args.command == "campaign":
+            campaign(args)
+        else:
+            generate(args)
 
     except Exception as e:
         logger.exception("program terminated:" + str(e), exc_info=True)
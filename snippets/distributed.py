@@ -0,0 +1,422 @@
+#!/usr/bin/python3
+"""Coordinator/worker protocol spreading simulations over several machines.
+
+The coordinator (in the generator's process) keeps a bounded queue of serialized tests: the test yaml,
+its obstacles and the mission files it refers to. Workers on any host connect over TCP, pull a test,
+run it on their own backend (AGENT) and push back the trajectory and the flight log. Messages are
+JSON lines; a worker opens with {"type": "hello", "token": COORDINATOR_TOKEN}, then sends
+{"type": "pull" | "renew" | "result" | "error", ...}, and gets a reply to everything but "renew".
+The coordinator only listens on localhost by default; listening on other interfaces requires a
+shared COORDINATOR_TOKEN, and connections with the wrong token are closed.
+
+A pulled test is leased to the worker: the worker renews the lease while the simulation runs, and a
+test whose lease expires, or whose worker disconnects, is handed out again (up to max_attempts times).
+submit() blocks while max_queued tests are waiting, so the generator cannot run ahead of the workers.
+
+    python3 distributed.py worker HOST:PORT     run a worker (backend chosen by AGENT)
+    python3 distributed.py demo                 coordinator, local kinematic workers and a short MCTS run
+"""
+import base64
+import collections
+import hmac
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from typing import List
+from decouple import config
+from aerialist.px4.drone_test import DroneTest, DroneTestResult
+from cache import trajectory_to_list, trajectory_from_list
+from checkpoint import obstacle_to_list, obstacle_from_list
+
+COORDINATOR_ADDRESS = config("COORDINATOR_ADDRESS", default="127.0.0.1:7700")
+# shared secret of the coordinator and its workers, required unless the coordinator only listens on localhost
+COORDINATOR_TOKEN = config("COORDINATOR_TOKEN", default="")
+REMOTE_LOGS = config("REMOTE_LOGS", default="./results/logs/")
+
+# files a test refers to, shipped along with it: (config section, attribute)
+TEST_FILES = [("drone", "mission_file"), ("drone", "params_file"), ("test", "commands_file")]
+
+logger = logging.getLogger(__name__)
+
+
+def parse_address(address: str):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def is_loopback(host: str) -> bool:
+    try:
+        return host == "localhost" or ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def serialize_test(test: DroneTest) -> dict:
+    handle, path = tempfile.mkstemp(suffix=".yaml")
+    os.close(handle)
+    try:
+        test.to_yaml(path)
+        with open(path) as f:
+            yaml = f.read()
+    finally:
+        os.remove(path)
+    files = {}
+    for section, attribute in TEST_FILES:
+        path = getattr(getattr(test, section, None), attribute, None)
+        if path is not None and os.path.isfile(path):
+            with open(path, "rb") as f:
+                files[f"{section}.{attribute}"] = [os.path.basename(path), base64.b64encode(f.read()).decode()]
+    return {
+        "yaml": yaml,
+        "obstacles": [obstacle_to_list(obst) for obst in test.simulation.obstacles or []],
+        "files": files,
+    }
+
+
+def deserialize_test(payload: dict, folder: str) -> DroneTest:
+    """Rebuild the test in folder, pointing it at local copies of its files"""
+    path = os.path.join(folder, "test.yaml")
+    with open(path, "w") as f:
+        f.write(payload["yaml"])
+    test = DroneTest.from_yaml(path)
+    test.simulation.obstacles = [obstacle_from_list(values) for values in payload["obstacles"]]
+    for key, (name, content) in payload["files"].items():
+        section, attribute = key.split(".")
+        local = os.path.join(folder, name)
+        with open(local, "wb") as f:
+            f.write(base64.b64decode(content))
+        setattr(getattr(test, section), attribute, local)
+    return test
+
+
+class Job(object):
+    def __init__(self, job_id: int, payload: dict):
+        self.id = job_id
+        self.payload = payload
+        self.future = Future()
+        self.attempts = 0
+        self.deadline = None
+        self.worker = None
+
+
+class Coordinator(object):
+    """Work queue of serialized tests served to remote workers; see the module docstring for the protocol"""
+
+    def __init__(self, address: str = COORDINATOR_ADDRESS, lease: float = 60.0, max_attempts: int = 3,
+                 max_queued: int = 16, poll: float = 2.0, logs_folder: str = REMOTE_LOGS, token: str = COORDINATOR_TOKEN):
+        if not token and not is_loopback(parse_address(address)[0]):
+            raise ValueError(f"the coordinator would accept tests from anyone on {address}: "
+                             f"set COORDINATOR_TOKEN, or listen on 127.0.0.1")
+        self.token = token
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.max_queued = max_queued
+        self.poll = poll
+        self.logs_folder = logs_folder
+        self.ids = itertools.count()
+        self.queue = collections.deque()
+        self.leases = {}
+        self.condition = threading.Condition()
+        self.closed = False
+        self.stats = collections.Counter()
+
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                coordinator.serve(self.rfile, self.wfile, f"{self.client_address[0]}:{self.client_address[1]}")
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(parse_address(address), Handler)
+        self.server.daemon_threads = True
+        self.address = "%s:%d" % self.server.server_address
+        threading.Thread(target=self.server.serve_forever, name="coordinator", daemon=True).start()
+        threading.Thread(target=self.reap, name="coordinator-leases", daemon=True).start()
+        logger.info(f"coordinator listening on {self.address}")
+
+    def submit(self, test: DroneTest) -> Future:
+        """Queue the test, waiting while max_queued tests are already waiting for a worker"""
+        job = Job(next(self.ids), serialize_test(test))
+        with self.condition:
+            while len(self.queue) >= self.max_queued and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                raise RuntimeError("the coordinator is closed")
+            self.queue.append(job)
+            self.condition.notify_all()
+        return job.future
+
+    def take(self, worker: str):
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.queue) != 0 or self.closed, self.poll) or self.closed:
+                return None
+            job = self.queue.popleft()
+            job.attempts += 1
+            job.worker = worker
+            job.deadline = time.monotonic() + self.lease
+            self.leases[job.id] = job
+            self.condition.notify_all()
+        return job
+
+    def renew(self, job_id: int, worker: str):
+        with self.condition:
+            job = self.leases.get(job_id)
+            if job is not None and job.worker == worker:
+                job.deadline = time.monotonic() + self.lease
+
+    def complete(self, job_id: int, message: dict):
+        with self.condition:
+            job = self.leases.pop(job_id, None)
+        if job is None or job.future.done():
+            # a late answer for a test that was handed out again, or already failed
+            return
+        log_file = None
+        if message.get("log") is not None:
+            os.makedirs(self.logs_folder, exist_ok=True)
+            # the name comes from the worker: keep it inside logs_folder
+            log_file = os.path.join(self.logs_folder, f"remote-{job.id}-{os.path.basename(message['log'][0])}")
+            with open(log_file, "wb") as f:
+                f.write(base64.b64decode(message["log"][1]))
+        self.stats["completed"] += 1
+        job.future.set_result([DroneTestResult(log_file=log_file, record=trajectory_from_list(message["trajectory"]))])
+
+    def retry(self, job: Job, reason: str):
+        """Hand the test out again, or fail it after max_attempts"""
+        if job.future.done():
+            return
+        if job.attempts >= self.max_attempts:
+            self.stats["failed"] += 1
+            job.future.set_exception(RuntimeError(f"simulation failed {job.attempts} times, last: {reason}"))
+            return
+        logger.warning(f"job {job.id} ({job.worker}) is retried: {reason}")
+        self.stats["retried"] += 1
+        with self.condition:
+            self.queue.appendleft(job)
+            self.condition.notify_all()
+
+    def release_worker(self, worker: str):
+        """Retry the tests leased to a worker that disconnected"""
+        with self.condition:
+            jobs = [job for job in self.leases.values() if job.worker == worker]
+            for job in jobs:
+                del self.leases[job.id]
+        for job in jobs:
+            self.retry(job, f"worker {worker} disconnected")
+
+    def reap(self):
+        while not self.closed:
+            time.sleep(min(1.0, self.lease / 4))
+            now = time.monotonic()
+            with self.condition:
+                expired = [job for job in self.leases.values() if job.deadline < now]
+                for job in expired:
+                    del self.leases[job.id]
+            for job in expired:
+                self.retry(job, "lease expired")
+
+    def serve(self, rfile, wfile, worker: str):
+        """One worker connection: check its token, then answer its messages until it disconnects"""
+        try:
+            hello = json.loads(rfile.readline() or "null")
+            if not isinstance(hello, dict) or hello.get("type") != "hello" or \
+                    not hmac.compare_digest(str(hello.get("token", "")).encode(), self.token.encode()):
+                logger.warning(f"connection from {worker} rejected: wrong token")
+                return
+            wfile.write((json.dumps({"type": "ack"}) + "\n").encode())
+            wfile.flush()
+            for line in rfile:
+                message = json.loads(line)
+                reply = None
+                if message["type"] == "pull":
+                    job = self.take(worker)
+                    if job is not None:
+                        reply = {"type": "job", "job": job.id, "lease": self.lease, "test": job.payload}
+                    else:
+                        reply = {"type": "stop" if self.closed else "wait"}
+                elif message["type"] == "renew":
+                    self.renew(message["job"], worker)
+                elif message["type"] == "result":
+                    self.complete(message["job"], message)
+                    reply = {"type": "ack"}
+                elif message["type"] == "error":
+                    with self.condition:
+                        job = self.leases.pop(message["job"], None)
+                    if job is not None:
+                        self.retry(job, message["message"])
+                    reply = {"type": "ack"}
+                if reply is not None:
+                    wfile.write((json.dumps(reply) + "\n").encode())
+                    wfile.flush()
+        except (OSError, ValueError) as e:
+            logger.info(f"worker {worker} connection lost: {e}")
+        finally:
+            self.release_worker(worker)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RemoteBackend(object):
+    """Simulation backend of the agent pool that runs the test on a remote worker. The flight is only
+    known once the worker reports back, so an early-abort monitor has nothing to follow"""
+    streams = False
+
+    def __init__(self, coordinator: Coordinator):
+        self.coordinator = coordinator
+
+    def run(self, test: DroneTest, monitor=None) -> List[DroneTestResult]:
+        return self.coordinator.submit(test).result()
+
+
+_coordinator = None
+_coordinator_lock = threading.Lock()
+
+
+def get_coordinator() -> Coordinator:
+    """Process-wide coordinator listening on COORDINATOR_ADDRESS"""
+    global _coordinator
+    with _coordinator_lock:
+        if _coordinator is None:
+            _coordinator = Coordinator()
+    return _coordinator
+
+
+class SimulationWorker(object):
+    """Pulls tests from a coordinator and runs them on a local backend, reconnecting if the connection drops"""
+
+    def __init__(self, address: str, backend=None, retry_delay: float = 2.0, token: str = COORDINATOR_TOKEN):
+        if backend is None:
+            from agent_pool import default_backend
+            backend = default_backend()
+        self.address = address
+        self.token = token
+        self.backend = backend
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.done = 0
+
+    def run(self, max_jobs: int = None):
+        """Work until the coordinator stops us, or after max_jobs tests"""
+        while max_jobs is None or self.done < max_jobs:
+            try:
+                with socket.create_connection(parse_address(self.address)) as connection:
+                    if self.work(connection, max_jobs) == "stop":
+                        return
+            except OSError as e:
+                logger.warning(f"coordinator {self.address} unreachable: {e}")
+                time.sleep(self.retry_delay)
+
+    def work(self, connection, max_jobs: int = None) -> str:
+        rfile = connection.makefile("rb")
+        wfile = connection.makefile("wb")
+        self.hello(rfile, wfile)
+        while max_jobs is None or self.done < max_jobs:
+            reply = self.request(rfile, wfile, {"type": "pull"})
+            if reply is None or reply["type"] == "stop":
+                return "stop"
+            if reply["type"] == "wait":
+                continue
+            self.request(rfile, wfile, self.execute(reply, wfile))
+            self.done += 1
+        return "stop"
+
+    def execute(self, job: dict, wfile) -> dict:
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(job["job"], job["lease"] / 3, wfile, stop), daemon=True)
+        heartbeat.start()
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                results = self.backend.run(deserialize_test(job["test"], folder))
+                message = {"type": "result", "job": job["job"], "trajectory": trajectory_to_list(results[0].record),
+                           "log": None}
+                log_file = results[0].log_file
+                if log_file is not None and os.path.isfile(log_file):
+                    with open(log_file, "rb") as f:
+                        message["log"] = [os.path.basename(log_file), base64.b64encode(f.read()).decode()]
+                return message
+        except Exception as e:
+            logger.exception(f"job {job['job']} failed")
+            return {"type": "error", "job": job["job"], "message": str(e)}
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    def hello(self, rfile, wfile):
+        if self.request(rfile, wfile, {"type": "hello", "token": self.token}) is None:
+            raise RuntimeError(f"coordinator {self.address} rejected the connection, check COORDINATOR_TOKEN")
+
+    def heartbeat(self, job_id: int, interval: float, wfile, stop: threading.Event):
+        while not stop.wait(interval):
+            self.send(wfile, {"type": "renew", "job": job_id})
+
+    def send(self, wfile, message: dict):
+        with self.lock:
+            wfile.write((json.dumps(message) + "\n").encode())
+            wfile.flush()
+
+    def request(self, rfile, wfile, message: dict):
+        self.send(wfile, message)
+        line = rfile.readline()
+        return json.loads(line) if line else None
+
+
+def run_worker(address: str, kinematic: bool = False, crash_after_pull: bool = False):
+    logging.basicConfig(level=logging.INFO, format="%(processName)s - %(name)s - %(levelname)s - %(message)s")
+    backend = None
+    if kinematic:
+        from fake_simulator import KinematicSimulator
+        backend = KinematicSimulator(realtime_factor=20)
+    worker = SimulationWorker(address, backend)
+    if crash_after_pull:
+        # a worker that dies in the middle of a simulation: the coordinator has to hand its test out again
+        with socket.create_connection(parse_address(address)) as connection:
+            rfile, wfile = connection.makefile("rb"), connection.makefile("wb")
+            worker.hello(rfile, wfile)
+            while worker.request(rfile, wfile, {"type": "pull"})["type"] == "wait":
+                pass
+        os._exit(1)
+    worker.run()
+
+
+def demo(workers: int = 3, budget: int = 20):
+    """End to end run on localhost: a coordinator, local worker processes on the kinematic backend
+    (one of which crashes with a test in hand) and an MCTS search driving them"""
+    import multiprocessing
+    from agent_pool import configure_pool
+    from mcts import MCTS
+    logging.basicConfig(level=logging.INFO, format="%(processName)s - %(name)s - %(levelname)s - %(message)s")
+    coordinator = Coordinator("127.0.0.1:0", lease=5.0, max_queued=workers)
+    processes = [multiprocessing.Process(target=run_worker, args=(coordinator.address, True), name=f"worker-{i}")
+                 for i in range(workers)]
+    processes.append(multiprocessing.Process(target=run_worker, args=(coordinator.address, True, True), name="crashing-worker"))
+    for process in processes:
+        process.start()
+    configure_pool(workers, lambda: RemoteBackend(coordinator))
+    generator = MCTS("case_studies/mission1.yaml", workers=workers)
+    test_cases = generator.generate(budget)
+    coordinator.close()
+    for process in processes:
+        process.join()
+    print(f"{len(test_cases)} test cases, coordinator: {dict(coordinator.stats)}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "worker":
+        run_worker(sys.argv[2])
+    elif len(sys.argv) >= 2 and sys.argv[1] == "demo":
+        demo()
+    else:
+        print(__doc__)
@@ -0,0 +1,54 @@
+import logging
+from typing import List, Optional
+import numpy as np
+from aerialist.px4.obstacle import Obstacle
+import geometry
+
+logger = logging.getLogger(__name__)
+
+HARD_FAILURE = "hard_failure"
+ALL_PASSED = "all_passed"
+
+
+class EarlyAbortMonitor(object):
+    """Follows a flight chunk by chunk and tells when its outcome with respect to the obstacles is settled:
+    a hard failure (closer than failure_distance to an obstacle, pruned by the search anyway), or every
+    obstacle passed (approached within approach_distance, then left more than pass_distance behind the
+    closest approach). A flight that never approaches some obstacle is never aborted. Without stop_when_passed,
+    only hard failures are settled: the rest of the flight is still needed to place further obstacles on it"""
+
+    def __init__(self, obstacles: List[Obstacle], failure_distance: float = 0.25, approach_distance: float = 5.0,
+                 pass_distance: float = 5.0, stop_when_passed: bool = True):
+        self.rectangles = geometry.obstacle_rectangles(obstacles)
+        self.stop_when_passed = stop_when_passed
+        self.failure_distance = failure_distance
+        self.approach_distance = approach_distance
+        self.pass_distance = pass_distance
+        self.minimum = np.full(len(self.rectangles), np.inf)
+        self.passed = np.zeros(len(self.rectangles), dtype=bool)
+        self.samples = 0
+        self.reason = None
+
+    def observe(self, points) -> Optional[int]:
+        """Feed the next (n, 2+) positions of the flight (x, y first). Return None while the outcome is open,
+        otherwise the number of these positions up to and including the one that settled it"""
+        points = np.asarray(points, dtype=float)[:, :2]
+        if self.reason is not None or len(self.rectangles) == 0 or len(points) == 0:
+            return None
+        distances = geometry.clearance_matrix(points, self.rectangles)
+        minimum = np.minimum.accumulate(np.vstack([self.minimum, distances]), axis=0)[1:]
+        passed = (minimum <= self.approach_distance) & (distances >= minimum + self.pass_distance)
+        passed = np.logical_or.accumulate(np.vstack([self.passed, passed]), axis=0)[1:]
+        failed = np.flatnonzero((distances < self.failure_distance).any(axis=1))
+        settled = np.flatnonzero(passed.all(axis=1)) if self.stop_when_passed else np.empty(0, dtype=int)
+        self.minimum = minimum[-1]
+        self.passed = passed[-1]
+        self.samples += len(points)
+        if len(failed) == 0 and len(settled) == 0:
+            return None
+        if len(settled) == 0 or (len(failed) != 0 and failed[0] <= settled[0]):
+            self.reason, index = HARD_FAILURE, failed[0]
+        else:
+            self.reason, index = ALL_PASSED, settled[0]
+        logger.debug(f"flight settled ({self.reason}) after {self.samples - len(points) + index + 1} samples")
+        return int(index) + 1
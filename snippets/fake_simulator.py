@@ -0,0 +1,134 @@
+import json
+import math
+import time
+from typing import List
+import numpy as np
+from aerialist.px4.drone_test import DroneTest, DroneTestResult
+from aerialist.px4.obstacle import Obstacle
+from aerialist.px4.position import Position
+from aerialist.px4.trajectory import Trajectory
+from early_abort import EarlyAbortMonitor
+
+EARTH_RADIUS = 6371000.0
+# mission items with a target position: waypoint, land, takeoff
+POSITION_COMMANDS = [16, 21, 22]
+
+
+def load_waypoints(mission_file: str) -> np.ndarray:
+    """(x, y, z) of the mission items of a QGroundControl .plan, in meters from the home position
+    (x to the north, y to the east, as in the flight logs)"""
+    with open(mission_file) as f:
+        mission = json.load(f)["mission"]
+    home_lat, home_lon = mission["plannedHomePosition"][:2]
+    waypoints = [(0.0, 0.0, 0.0)]
+    for item in mission["items"]:
+        if item.get("command") not in POSITION_COMMANDS or item["params"][4] is None:
+            continue
+        lat, lon, alt = item["params"][4:7]
+        x = math.radians(lat - home_lat) * EARTH_RADIUS
+        y = math.radians(lon - home_lon) * EARTH_RADIUS * math.cos(math.radians(home_lat))
+        waypoints.append((x, y, alt))
+    return np.array(waypoints, dtype=float)
+
+
+class KinematicSimulator(object):
+    """Stand-in for PX4: flies straight between the mission waypoints at a constant speed and
+    slides along any obstacle it would get closer to than clearance, cutting the corners of the
+    detour (a moving average over smoothing samples). Deterministic, and needs neither PX4 nor
+    Docker, so it can drive the generators for profiling and benchmarks"""
+    streams = True
+
+    def __init__(self, speed: float = 5.0, rate: float = 10.0, clearance: float = 1.5, smoothing: int = 5,
+                 realtime_factor: float = 0.0):
+        self.speed = speed
+        self.rate = rate
+        self.clearance = clearance
+        self.smoothing = smoothing
+        # sleep for flight duration / realtime_factor, to emulate the simulation cost (0 = no sleep)
+        self.realtime_factor = realtime_factor
+
+    def fly(self, waypoints: np.ndarray, obstacles: List[Obstacle]) -> np.ndarray:
+        """(n, 3) positions sampled at rate along the mission"""
+        step = self.speed / self.rate
+        path = [waypoints[:1]]
+        for start, end in zip(waypoints[:-1], waypoints[1:]):
+            count = max(1, int(math.ceil(np.linalg.norm(end - start) / step)))
+            path.append(start + (end - start) * (np.arange(1, count + 1) / count)[:, None])
+        points = np.concatenate(path)
+        for obst in obstacles:
+            points[:, :2] = self.deflect(points[:, :2], obst)
+        if self.smoothing > 1 and len(points) > self.smoothing:
+            # pad with the end points so that the start and the end of the mission stay in place
+            padded = np.pad(points[:, :2], ((self.smoothing // 2, self.smoothing - 1 - self.smoothing // 2), (0, 0)), mode="edge")
+            kernel = np.ones(self.smoothing) / self.smoothing
+            points[:, 0] = np.convolve(padded[:, 0], kernel, mode="valid")
+            points[:, 1] = np.convolve(padded[:, 1], kernel, mode="valid")
+        return points
+
+    def deflect(self, points: np.ndarray, obstacle: Obstacle) -> np.ndarray:
+        """Move each pass of the path that gets closer than clearance to the obstacle
+        onto the side of its safety margin that the pass is already closest to"""
+        r_radian = math.radians(obstacle.position.r)
+        cos, sin = math.cos(r_radian), math.sin(r_radian)
+        dx = points[:, 0] - obstacle.position.x
+        dy = points[:, 1] - obstacle.position.y
+        local = np.column_stack([cos * dx + sin * dy, -sin * dx + cos * dy])
+        half = np.array([obstacle.size.l / 2 + self.clearance, obstacle.size.w / 2 + self.clearance])
+        inside = np.flatnonzero((np.abs(local) < half).all(axis=1))
+        # consecutive samples inside the margin form one pass
+        for run in np.split(inside, np.flatnonzero(np.diff(inside) != 1) + 1):
+            if len(run) == 0:
+                continue
+            direction = np.abs(local[run[-1]] - local[run[0]])
+            # slide along the obstacle: push across the direction of travel
+            axis = 1 if direction[0] >= direction[1] else 0
+            side = 1.0 if local[run, axis].mean() >= 0 else -1.0
+            local[run, axis] = side * half[axis]
+        return np.column_stack([
+            obstacle.position.x + cos * local[:, 0] - sin * local[:, 1],
+            obstacle.position.y + sin * local[:, 0] + cos * local[:, 1],
+        ])
+
+    def run(self, test: DroneTest, monitor: EarlyAbortMonitor = None) -> List[DroneTestResult]:
+        """Fly the test; with a monitor, the flight is fed to it one second at a time and
+        stops as soon as the monitor settles the outcome"""
+        points = self.fly(load_waypoints(test.drone.mission_file), test.simulation.obstacles or [])
+        timestamps = (np.arange(len(points)) * 1e6 / self.rate).astype(int)
+        points = replay(points, self.rate, self.realtime_factor, monitor)
+        positions = [Position(x=x, y=y, z=z, r=0, timestamp=int(t)) for (x, y, z), t in zip(points.tolist(), timestamps)]
+        return [DroneTestResult(log_file=None, record=Trajectory(positions))]
+
+
+class ReplayBackend(object):
+    """Stand-in that replays a recorded flight (a Trajectory, or a .ulg log) whatever the test,
+    so that early abort can be checked against real flight data without PX4"""
+    streams = True
+
+    def __init__(self, record, rate: float = 10.0, realtime_factor: float = 0.0):
+        if isinstance(record, str):
+            self.log_file = record
+            record = Trajectory.extract_from_log(record)
+        else:
+            self.log_file = None
+        self.positions = record.positions
+        self.rate = rate
+        self.realtime_factor = realtime_factor
+
+    def run(self, test: DroneTest, monitor: EarlyAbortMonitor = None) -> List[DroneTestResult]:
+        points = np.array([(p.x, p.y, p.z) for p in self.positions], dtype=float).reshape(-1, 3)
+        count = len(replay(points, self.rate, self.realtime_factor, monitor))
+        return [DroneTestResult(log_file=self.log_file, record=Trajectory(self.positions[:count]))]
+
+
+def replay(points: np.ndarray, rate: float, realtime_factor: float = 0.0, monitor: EarlyAbortMonitor = None) -> np.ndarray:
+    """Play the flight back one second (rate samples) at a time, sleeping for its duration / realtime_factor
+    (0 = no sleep); return the positions flown before the monitor, if any, settled the outcome"""
+    chunk = max(1, int(rate))
+    for start in range(0, len(points), chunk):
+        if realtime_factor > 0:
+            time.sleep(len(points[start:start + chunk]) / rate / realtime_factor)
+        if monitor is not None:
+            settled = monitor.observe(points[start:start + chunk])
+            if settled is not None:
+                return points[:start + settled]
+    return points
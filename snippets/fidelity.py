@@ -0,0 +1,53 @@
+import logging
+import threading
+import numpy as np
+from artefacts import get_artefacts
+from scenarioState import ScenarioState
+from testcase import TestCase
+
+logger = logging.getLogger(__name__)
+
+FULL_SPEED = 1
+
+
+class MultiFidelityEvaluator(object):
+    """Screens every candidate with an accelerated simulation and re-flies at speed 1 only those whose
+    screened min distance is below confirm_threshold, while the confirmation budget lasts.
+    Only confirmed results may be reported as test cases"""
+
+    def __init__(self, screen_speed: float, confirm_threshold: float = 1.5, confirm_budget: int = 50):
+        self.screen_speed = screen_speed
+        self.confirm_threshold = confirm_threshold
+        self.confirm_budget = confirm_budget
+        self.confirmations = 0
+        self.pairs = []  # (screened, confirmed) min distances
+        self.lock = threading.Lock()
+
+    def evaluate(self, state: ScenarioState, use_cache: bool = True):
+        reward, min_distance, test_case = state.get_reward(speed=self.screen_speed, use_cache=use_cache)
+        invalid = reward == 0.0 and len(state.scenario) != 0
+        if invalid or abs(min_distance) > self.confirm_threshold:
+            return reward, min_distance, test_case
+        with self.lock:
+            if self.confirmations >= self.confirm_budget:
+                return reward, min_distance, test_case
+            self.confirmations += 1
+        confirmed = state.get_reward(speed=FULL_SPEED, use_cache=use_cache)
+        get_artefacts().discard(test_case)
+        with self.lock:
+            self.pairs.append((abs(min_distance), abs(confirmed[1])))
+        logger.info(f"screened min distance: {abs(min_distance):.2f}, confirmed: {abs(confirmed[1]):.2f}")
+        return confirmed
+
+    @staticmethod
+    def is_confirmed(test_case: TestCase) -> bool:
+        return test_case.test.simulation.speed == FULL_SPEED
+
+    def correlation(self) -> float:
+        """Pearson correlation between the screened and the confirmed min distances"""
+        if len(self.pairs) < 2:
+            return float("nan")
+        screened, confirmed = np.array(self.pairs).T
+        if screened.std() == 0 or confirmed.std() == 0:
+            return float("nan")
+        return float(np.corrcoef(screened, confirmed)[0, 1])
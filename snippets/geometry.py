@@ -0,0 +1,98 @@
+"""Array-based versions of the obstacle placement geometry in utils.py.
+Rectangles are (x, y, l, w, r) rows with r in degrees (counterclockwise), circles are (cx, cy, radius) rows."""
+import numpy as np
+
+
+def as_rectangles(rectangles):
+    return np.asarray(rectangles, dtype=float).reshape(-1, 5)
+
+
+def obstacle_rectangles(obstacles):
+    """(m, 5) rectangles of aerialist obstacles"""
+    return as_rectangles([(ob.position.x, ob.position.y, ob.size.l, ob.size.w, ob.position.r) for ob in obstacles])
+
+
+def rectangle_distances(points, x, y, l, w, r):
+    """Distances of an (n, 2) array of points to the rectangle (x, y, l, w, r), 0 inside it"""
+    return clearance_matrix(points, [(x, y, l, w, r)])[:, 0]
+
+
+def clearance_matrix(points, rectangles):
+    """Exact (n, m) distance matrix between n points and m rotated rectangles, 0 inside a rectangle"""
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    rectangles = as_rectangles(rectangles)
+    r_radian = np.radians(rectangles[:, 4])
+    cos, sin = np.cos(r_radian), np.sin(r_radian)
+    dx = points[:, 0, None] - rectangles[None, :, 0]
+    dy = points[:, 1, None] - rectangles[None, :, 1]
+    # rotate the points into each rectangle's frame
+    local_x = cos * dx + sin * dy
+    local_y = -sin * dx + cos * dy
+    outside_x = np.maximum(np.abs(local_x) - rectangles[:, 2] / 2, 0)
+    outside_y = np.maximum(np.abs(local_y) - rectangles[:, 3] / 2, 0)
+    return np.hypot(outside_x, outside_y)
+
+
+def min_clearances(points, rectangles):
+    """Distance of the closest of the points to each rectangle, from a single (n, m) clearance matrix"""
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    rectangles = as_rectangles(rectangles)
+    if len(points) == 0:
+        return np.full(len(rectangles), np.inf)
+    return clearance_matrix(points, rectangles).min(axis=0)
+
+
+def boundary_distances(centers, upper_b, lower_b, left_b, right_b):
+    """Distance of each center to the closest border of the placement area"""
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    return np.minimum.reduce([
+        upper_b - centers[:, 1],
+        centers[:, 1] - lower_b,
+        centers[:, 0] - left_b,
+        right_b - centers[:, 0],
+    ])
+
+
+def subrectangles(rectangles, count=4):
+    """Subdivide every rectangle count times in x and y direction: (m * count * count, 5)"""
+    rectangles = as_rectangles(rectangles)
+    x, y, l, w, r = (rectangles[:, i, None, None] for i in range(5))
+    # centers of the sub-rectangles in the rectangle's own frame
+    offsets = (np.arange(count) + 0.5) / count - 0.5
+    dx = np.broadcast_to(offsets[None, :, None] * l, (len(rectangles), count, count))
+    dy = np.broadcast_to(offsets[None, None, :] * w, (len(rectangles), count, count))
+    r_radian = np.radians(r)
+    sub_x = x + np.cos(r_radian) * dx - np.sin(r_radian) * dy
+    sub_y = y + np.sin(r_radian) * dx + np.cos(r_radian) * dy
+    shape = sub_x.shape
+    return np.stack([
+        sub_x,
+        sub_y,
+        np.broadcast_to(l / count, shape),
+        np.broadcast_to(w / count, shape),
+        np.broadcast_to(r, shape),
+    ], axis=-1).reshape(-1, 5)
+
+
+def circle_coverage(rectangles, subdivision_count=4):
+    """Circles (cx, cy, radius) that together encompass each of the given rectangles"""
+    subs = subrectangles(rectangles, subdivision_count)
+    return np.column_stack([subs[:, 0], subs[:, 1], np.hypot(subs[:, 2] / 2, subs[:, 3] / 2)])
+
+
+def free_radii(centers, bounds, rectangles=(), exact=True, subdivision_count=4):
+    """Radius of the largest circle around each center that stays inside bounds = (upper_b, lower_b, left_b, right_b)
+    and does not intersect the rectangles; exact uses the rotated-rectangle distance instead of the circle coverage"""
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    radii = boundary_distances(centers, *bounds)
+    rectangles = as_rectangles(rectangles)
+    if len(rectangles) == 0:
+        return radii
+    if exact:
+        obstacle_distances = clearance_matrix(centers, rectangles).min(axis=1)
+    else:
+        circles = circle_coverage(rectangles, subdivision_count)
+        distances = np.hypot(centers[:, 0, None] - circles[None, :, 0], centers[:, 1, None] - circles[None, :, 1])
+        obstacle_distances = (distances - circles[None, :, 2]).min(axis=1)
+    return np.minimum(radii, obstacle_distances)
+
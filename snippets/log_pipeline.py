@@ -0,0 +1,110 @@
+import atexit
+import contextlib
+import contextvars
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from decouple import config
+
+LOG_FOLDER = config("LOG_FOLDER", default="logs/")
+# size of a log file before it is rotated, in MB, and number of rotated files kept
+LOG_MAX_MB = config("LOG_MAX_MB", default=50, cast=float)
+LOG_BACKUPS = config("LOG_BACKUPS", default=5, cast=int)
+# debug records per second allowed from one logger (0 = no limit)
+DEBUG_RATE = config("DEBUG_RATE", default=200, cast=float)
+
+FORMAT = "%(asctime)s - %(worker)s - it %(iteration)s node %(node)s - %(name)s - %(levelname)s - %(message)s"
+CONSOLE_FORMAT = "%(worker)s - %(name)s - %(levelname)s - %(message)s"
+
+_context = contextvars.ContextVar("log_context", default={})
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Attach fields (iteration, node, worker) to the records logged inside the block, in this thread
+    and in the simulations it submits to the agent pool"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Adds the current log context to the record; the worker defaults to the thread name"""
+
+    def filter(self, record):
+        fields = _context.get()
+        record.iteration = fields.get("iteration", "-")
+        record.node = fields.get("node", "-")
+        record.worker = fields.get("worker", record.threadName)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per logger for DEBUG records: at most rate per second, in bursts of up to burst.
+    The first record let through after some were dropped says how many"""
+
+    def __init__(self, rate: float = DEBUG_RATE, burst: float = None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno > logging.DEBUG:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            tokens, last, dropped = self.buckets.get(record.name, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[record.name] = (tokens, now, dropped + 1)
+                return False
+            self.buckets[record.name] = (tokens - 1, now, 0)
+        if dropped != 0:
+            record.msg = f"{record.getMessage()} ({dropped} debug messages from {record.name} dropped before this)"
+            record.args = None
+        return True
+
+
+def configure_logging(folder: str = LOG_FOLDER, max_mb: float = LOG_MAX_MB, backups: int = LOG_BACKUPS,
+                      debug_rate: float = DEBUG_RATE) -> logging.handlers.QueueListener:
+    """Route the root logger through a queue: callers only enqueue the record, and one listener thread
+    writes it to the console (INFO), logs/info.txt (INFO) and logs/debug.txt (DEBUG, rate-limited),
+    both rotated at max_mb"""
+    os.makedirs(folder, exist_ok=True)
+    max_bytes = int(max_mb * 1024 * 1024)
+
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+
+    handlers = [console]
+    for name, level in [("info.txt", logging.INFO), ("debug.txt", logging.DEBUG)]:
+        handler = logging.handlers.RotatingFileHandler(os.path.join(folder, name), maxBytes=max_bytes,
+                                                       backupCount=backups)
+        handler.setLevel(level)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        handlers.append(handler)
+
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    # both filters run in the logging thread, before the record is enqueued
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(RateLimitFilter(debug_rate))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(logging.DEBUG)
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -1,123 +1,516 @@
-import math
-import random
-from datetime import datetime
-from typing import List
-from scenarioState import ScenarioState
-from testcase import TestCase
-import sys
-import os
-
-
-class Node:
-    def __init__(self, state: ScenarioState, parent):
-        self.state = state
-        self.parent = parent
-        self.visits = 0
-        self.reward = 0.0
-        self.children = []
-        self.score = 0
-        self.id = 0
-
-    def __str__(self):
-        return f"state: \n {str(self.state)}, visits: {self.visits}, reward: {self.reward}"
-
-
-class MCTS:
-    def __init__(self, case_study_file: str)-> None:
-        self.initial_state = ScenarioState(case_study_file)
-        self.root = Node(self.initial_state, None)
-        self.count = 0
-
-        # hyperparameters for UCB1 and progressive widening
-        self.exploration_rate = 1 / math.sqrt(2)
-        self.C = 0.5
-        self.alpha = 0.5
-        self.C_list = [0.4, 0.5, 0.6, 0.7]
-
-        # results
-        self.test_cases = []
-
-    def select(self, node: Node):
-        while not node.state.is_terminal():
-            layer = len(node.state.scenario)
-            # progressive widening
-            if len(node.children) <= self.C_list[layer] * (node.visits ** self.alpha):
-                return self.expand(node)
-            else:
-                node = self.best_child(node)
-
-        return node
-
-    def expand(self, node: Node):
-        tried_children_state = []
-        candidate_siblings = []
-        for child in node.children:
-            tried_children_state.append(child.state)
-            if (child.score == 1 or child.score == 2) and child.state.check_min_distance_to_last_obstacle() is True:
-                candidate_siblings.append(child)
-
-        if len(candidate_siblings) != 0:  # modify an existing sibling
-            sibling = random.choice(candidate_siblings)
-            new_state = sibling.state.modify_state()
-        else:  # add a new obstacle to this node
-            new_state = node.state.next_state()
-            while new_state in tried_children_state and not new_state.is_terminal():
-                new_state = node.state.next_state()
-
-        if new_state is None or len(node.state.scenario) == len(new_state.scenario):
-            return None
-        else:
-            new_node = Node(new_state, node)
-            self.count += 1
-            new_node.id = self.count
-            node.children.append(new_node)
-            return new_node
-
-    def simulate(self, state):
-        return state.get_reward()
-
-    @staticmethod
-    def back_propogate(node, reward):
-        while node is not None:
-            node.visits += 1
-            node.reward += reward
-            node = node.parent
-
-    def search(self):
-        node = self.select(self.root)
-        if node is not None:
-            reward, min_distance, test_case = self.simulate(node.state)
-            self.count += 1
-            if abs(min_distance) < 0.25:
-                node.score = 5
-            elif 0.25 <= abs(min_distance) <= 1:
-                node.score = 2
-            elif 1 <= abs(min_distance) <= 1.5:
-                node.score = 1
-
-            # delete the node if it is invalid, or it is a hard failure (min_dis < 0.25m)
-            if (reward == 0.0 and len(node.state.scenario) != 0) or abs(min_distance) < 0.25:
-                node.parent.children.remove(node)
-                node.parent = None
-
-            if 0 <= abs(min_distance) <= 1.5:
-                self.test_cases.append(test_case)
-
-            self.back_propogate(node, reward)
-
-    def generate(self, budget: int) -> List[TestCase]:
-        reward, distance, test_case = self.simulate(self.root.state)
-        self.back_propogate(self.root, reward)
-        for i in range(budget):
-            self.search()
-        return self.test_cases
-
-    def best_child(self, node):
-        # UCB1
-        return max(node.children, key=lambda child: child.reward / child.visits +
-                                             self.exploration_rate * math.sqrt(2 * math.log(node.visits) / child.visits))
-
-
-if __name__ == '__main__':
-    generator = MCTS("case_studies/mission2.yaml")
-    generator.generate(200)
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from typing import Iterator, List
+from artefacts import get_artefacts
+from checkpoint import CheckpointJournal
+from fidelity import MultiFidelityEvaluator
+from log_pipeline import log_context
+from plotting import render_plots
+from refinement import PatternSearch
+from rng import rng
+from scenarioState import ScenarioState
+from similarity import ScenarioIndex
+from surrogate import GeometricSurrogate
+from telemetry import telemetry
+from trajectory_store import TrajectoryLost, trajectory_store
+from testcase import TestCase
+import sys
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class NodeStats(object):
+    """Visit statistics and simulation result, shared by all the nodes of equivalent states (transpositions)"""
+    __slots__ = ("visits", "reward", "result", "state")
+
+    def __init__(self):
+        self.visits = 0
+        self.reward = 0.0
+        # (reward, min_distance, test_case) of the first simulation, and the simulated state
+        self.result = None
+        self.state = None
+
+
+class Node:
+    def __init__(self, state: ScenarioState, parent, stats: NodeStats = None):
+        self.state = state
+        self.parent = parent
+        self.stats = stats if stats is not None else NodeStats()
+        self.children = []
+        self.score = 0
+        self.id = 0
+        # simulations currently in flight in this node's subtree (parallel mode)
+        self.pending = 0
+        # surrogate's (min distance, obstruction) prediction, if the node was screened
+        self.prediction = None
+        # whether the node already took over an equivalent node's result (see MCTS.reuse)
+        self.reused = False
+
+    @property
+    def visits(self):
+        return self.stats.visits
+
+    @visits.setter
+    def visits(self, value):
+        self.stats.visits = value
+
+    @property
+    def reward(self):
+        return self.stats.reward
+
+    @reward.setter
+    def reward(self, value):
+        self.stats.reward = value
+
+    def __str__(self):
+        return f"state: \n {str(self.state)}, visits: {self.visits}, reward: {self.reward}"
+
+
+class MCTS:
+    def __init__(self, case_study_file: str, workers: int = 1, surrogate_threshold: float = None,
+                 checkpoint: str = None, screen_speed: float = None, confirm_threshold: float = 1.5,
+                 confirm_budget: int = 50, duplicate_tolerance: float = 0.2, memory_cap: float = None,
+                 refine_budget: int = 0, refine_evaluations: int = 8)-> None:
+        self.initial_state = ScenarioState(case_study_file)
+        # transposition table: canonical obstacle set -> statistics shared by its nodes
+        self.table = {}
+        self.root = Node(self.initial_state, None, self.transposition(self.initial_state))
+        self.count = 0
+        # nodes attached to the tree, including the root
+        self.tree_size = 1
+        # search iterations that are finished, counted against the budget
+        self.iterations = 0
+
+        # every finished simulation is appended to the checkpoint journal, if given
+        self.journal = CheckpointJournal(checkpoint) if checkpoint is not None else None
+
+        # number of simulations kept in flight; an in-flight simulation counts as a visit
+        # that returned the worst reward (virtual loss), so concurrent selections spread out
+        self.workers = workers
+        self.virtual_loss = self.initial_state.max_distance
+        self.in_flight = set()
+
+        # geometric pre-screening of expansions, disabled if no threshold is given
+        self.surrogate = GeometricSurrogate(surrogate_threshold) if surrogate_threshold is not None else None
+
+        # trajectories of terminal and pruned nodes are evicted above memory_cap MB (TREE_MEMORY_MB by default)
+        if memory_cap is not None:
+            trajectory_store.max_bytes = int(memory_cap * 1024 * 1024)
+
+        # near-duplicates of simulated scenarios are replaced before simulation, and of kept test cases
+        # left out of the results; disabled if no tolerance is given (position and size tolerance, in meters)
+        self.simulated_index = None
+        self.suite_index = None
+        if duplicate_tolerance is not None:
+            self.simulated_index = ScenarioIndex(duplicate_tolerance, duplicate_tolerance)
+            self.suite_index = ScenarioIndex(duplicate_tolerance, duplicate_tolerance)
+        self.max_retries = self.surrogate.max_retries if self.surrogate is not None else 5
+
+        # screening simulations at screen_speed, confirmed at full fidelity; disabled if no speed is given
+        self.evaluator = None
+        if screen_speed is not None:
+            self.evaluator = MultiFidelityEvaluator(screen_speed, confirm_threshold, confirm_budget)
+
+        # the last refine_budget iterations of a run are spent on a pattern search around the closest near-misses,
+        # at most refine_evaluations simulations each
+        self.refine_budget = refine_budget
+        self.refine_evaluations = refine_evaluations
+
+        # hyperparameters for UCB1 and progressive widening
+        self.exploration_rate = 1 / math.sqrt(2)
+        self.C = 0.5
+        self.alpha = 0.5
+        self.C_list = [0.4, 0.5, 0.6, 0.7]
+
+        # results
+        self.test_cases = []
+
+    def select(self, node: Node):
+        with telemetry.span("select"):
+            while not node.state.is_terminal():
+                layer = len(node.state.scenario)
+                # progressive widening
+                if len(node.children) <= self.C_list[layer] * ((node.visits + node.pending) ** self.alpha):
+                    return self.screen(self.expand(node))
+                else:
+                    node = self.best_child(node)
+                    if node is None:
+                        return None
+
+            return node
+
+    def expand(self, node: Node):
+        with telemetry.span("expand"):
+            tried_children_state = set()
+            candidate_siblings = []
+            for child in node.children:
+                tried_children_state.add(child.state)
+                if (child.score == 1 or child.score == 2) and child.state.check_min_distance_to_last_obstacle() is True \
+                        and not child.state.flight_lost():
+                    candidate_siblings.append(child)
+
+            while len(candidate_siblings) != 0:  # modify an existing sibling
+                sibling = rng().choice(candidate_siblings)
+                try:
+                    new_state = sibling.state.modify_state()
+                    break
+                except TrajectoryLost as e:
+                    # its flight was evicted and cannot be reloaded anymore: the sibling can no longer be modified
+                    logger.warning(f"node {sibling.id} is no longer modified: {e}")
+                    telemetry.count("lost_trajectories")
+                    candidate_siblings.remove(sibling)
+            else:  # add a new obstacle to this node
+                new_state = node.state.next_state()
+                while new_state in tried_children_state and not new_state.is_terminal():
+                    telemetry.count("candidate_retries")
+                    new_state = node.state.next_state()
+
+            if new_state is None or len(node.state.scenario) == len(new_state.scenario):
+                return None
+            else:
+                return self.add_child(node, new_state)
+
+    def add_child(self, node: Node, state: ScenarioState) -> Node:
+        new_node = Node(state, node, self.transposition(state))
+        self.count += 1
+        new_node.id = self.count
+        node.children.append(new_node)
+        self.tree_size += 1
+        telemetry.count("nodes_created")
+        return new_node
+
+    def screen(self, node: Node):
+        """Replace expansions that are near-duplicates of already simulated scenarios, or that the surrogate
+        predicts to be uninteresting, up to max_retries times; the last candidate is kept anyway so the
+        iteration still runs a simulation"""
+        if node is None:
+            return None
+        for i in range(self.max_retries):
+            if not self.rejected(node):
+                break
+            parent = node.parent
+            parent.children.remove(node)
+            node.parent = None
+            self.tree_size -= 1
+            node = self.expand(parent)
+            if node is None:
+                return None
+        if self.surrogate is not None and node.prediction is None and len(node.parent.state.trajectory_2d) != 0:
+            node.prediction = self.surrogate.predict(node.parent.state.trajectory_2d, node.state.scenario)
+        if self.simulated_index is not None:
+            self.simulated_index.add(node.state.scenario)
+        return node
+
+    def transposition(self, state: ScenarioState) -> NodeStats:
+        stats = self.table.get(state)
+        if stats is None:
+            stats = self.table[state] = NodeStats()
+        return stats
+
+    def rejected(self, node: Node) -> bool:
+        if node.stats.result is not None:
+            # a transposition of a simulated state costs no simulation
+            return False
+        if self.simulated_index is not None and self.simulated_index.is_duplicate(node.state.scenario):
+            telemetry.count("duplicate_skips")
+            return True
+        if self.surrogate is None or len(node.parent.state.trajectory_2d) == 0:
+            return False
+        node.prediction = self.surrogate.predict(node.parent.state.trajectory_2d, node.state.scenario)
+        if self.surrogate.is_interesting(node.prediction):
+            return False
+        self.surrogate.skipped += 1
+        telemetry.count("surrogate_skips")
+        return True
+
+    def reuse(self, node: Node):
+        """The result of an equivalent node's simulation, if there is one"""
+        # reused once per node: a node selected again is simulated again, like any terminal node
+        if node.reused or node.stats.result is None or node.stats.state is node.state:
+            return None
+        node.reused = True
+        node.state.adopt(node.stats.state)
+        telemetry.count("transpositions")
+        return node.stats.result
+
+    def simulate(self, state, use_cache: bool = True, **context):
+        """Simulate the state; a state simulated before is flown again (use_cache False), since the cache
+        would only hand back the same result at the price of an iteration"""
+        with log_context(**context):
+            if self.evaluator is not None:
+                return self.evaluator.evaluate(state, use_cache)
+            return state.get_reward(use_cache=use_cache)
+
+    @staticmethod
+    def back_propogate(node, reward):
+        with telemetry.span("back_propogate"):
+            while node is not None:
+                node.visits += 1
+                node.reward += reward
+                node = node.parent
+
+    @staticmethod
+    def add_pending(node, count):
+        while node is not None:
+            node.pending += count
+            node = node.parent
+
+    def search(self):
+        """Run one search iteration, return the test case it found, if any"""
+        node = self.select(self.root)
+        if node is not None and self.reuse(node) is not None:
+            # no simulation, so not counted against the budget
+            return self.record_result(node, *node.stats.result)
+        self.iterations += 1
+        if node is not None:
+            reward, min_distance, test_case = self.simulate(node.state, node.stats.result is None,
+                                                            iteration=self.iterations, node=node.id)
+            return self.record_result(node, reward, min_distance, test_case)
+        return None
+
+    def parallel_search(self, budget: int) -> Iterator[TestCase]:
+        """Run budget search iterations keeping up to self.workers simulations in flight,
+        yielding the test cases as their simulations complete"""
+        futures = {}
+        started = self.iterations
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while started < budget or len(futures) != 0:
+                while started < budget and len(futures) < self.workers:
+                    node = self.select(self.root)
+                    if node is None and len(futures) != 0:
+                        # the reachable part of the tree is waiting for results, retry after one completes
+                        break
+                    if node is not None and self.reuse(node) is not None:
+                        test_case = self.record_result(node, *node.stats.result)
+                        if test_case is not None:
+                            yield test_case
+                        continue
+                    started += 1
+                    if node is None:
+                        self.iterations += 1
+                    else:
+                        self.in_flight.add(node)
+                        self.add_pending(node, 1)
+                        futures[executor.submit(self.simulate, node.state, node.stats.result is None,
+                                                iteration=started, node=node.id)] = node
+
+                if len(futures) == 0:
+                    continue
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = futures.pop(future)
+                    self.in_flight.discard(node)
+                    self.add_pending(node, -1)
+                    self.iterations += 1
+                    reward, min_distance, test_case = future.result()
+                    if self.record_result(node, reward, min_distance, test_case) is not None:
+                        yield test_case
+
+    def record_result(self, node: Node, reward, min_distance, test_case):
+        """Score the simulated node, prune it if needed and backpropagate its reward.
+        Return the test case if it is kept"""
+        self.count += 1
+        parent_id = node.parent.id
+        if node.stats.result is None:
+            node.stats.result = (reward, min_distance, test_case)
+            node.stats.state = node.state
+        if node.prediction is not None and reward != 0.0:
+            self.surrogate.record(node.prediction, abs(min_distance))
+        if abs(min_distance) < 0.25:
+            node.score = 5
+        elif 0.25 <= abs(min_distance) <= 1:
+            node.score = 2
+        elif 1 <= abs(min_distance) <= 1.5:
+            node.score = 1
+
+        # delete the node if it is invalid, or it is a hard failure (min_dis < 0.25m)
+        invalid = reward == 0.0 and len(node.state.scenario) != 0
+        pruned = invalid or abs(min_distance) < 0.25
+        evictable = (pruned or node.state.is_terminal()) and node.state.track is not node.parent.state.track
+        if pruned:
+            node.parent.children.remove(node)
+            node.parent = None
+            self.tree_size -= 1
+            telemetry.count("pruned")
+        if invalid:
+            telemetry.count("invalid_simulations")
+
+        # a transposition reusing a kept result brings back the same test case: it is not kept twice
+        already_kept = any(test_case is kept_case for kept_case in self.test_cases)
+        kept = 0 <= abs(min_distance) <= 1.5 and not already_kept
+        if self.evaluator is not None:
+            kept = kept and self.evaluator.is_confirmed(test_case)
+        if kept and self.suite_index is not None:
+            if self.suite_index.is_duplicate(node.state.scenario):
+                kept = False
+                telemetry.count("duplicate_test_cases")
+            else:
+                self.suite_index.add(node.state.scenario)
+        if kept:
+            self.test_cases.append(test_case)
+        elif not already_kept:
+            # the state keeps the flight compactly, the test case's copy and artefacts are not needed anymore
+            test_case.release()
+            get_artefacts().discard(test_case)
+        # a node that can no longer be expanded lets its own trajectory be evicted (a failed simulation shares its parent's)
+        if evictable:
+            trajectory_store.release(node.state.track)
+
+        self.back_propogate(node, reward)
+        if self.journal is not None:
+            self.journal.record_simulation(node, parent_id, self.iterations, self.count, reward, min_distance, test_case)
+        telemetry.gauge("depth", len(node.state.scenario))
+        telemetry.gauge("tree_size", self.tree_size)
+        telemetry.end_iteration(iteration=self.iterations, node=node.id, depth=len(node.state.scenario),
+                                reward=reward, min_distance=min_distance, score=node.score, pruned=pruned, kept=kept)
+        return test_case if kept else None
+
+    def resume(self, checkpoint: str):
+        """Rebuild the tree, the collected test cases and the random state from a checkpoint journal,
+        without re-simulating anything"""
+        journal, self.journal = self.journal, None
+        nodes = {}
+        records = CheckpointJournal.load(checkpoint)
+        for record in records:
+            scenario = CheckpointJournal.scenario(record)
+            if record["node"] in nodes:
+                node = nodes[record["node"]]
+            elif record["parent"] is None:
+                node = self.root
+            else:
+                parent = nodes[record["parent"]]
+                state = parent.state.child(scenario)
+                node = Node(state, parent, self.transposition(state))
+                node.id = record["node"]
+                parent.children.append(node)
+                self.tree_size += 1
+            nodes[node.id] = node
+
+            trajectory = CheckpointJournal.trajectory(record)
+            test_case = TestCase(node.state.context.template, scenario)
+            # restored, not simulated: its artefacts are left alone
+            test_case.cached = True
+            if trajectory is not None:
+                node.state.set_trajectory(trajectory, test_case.test, record["log_file"])
+                test_case.load_results(trajectory, record["log_file"], plot_file=record["plot_file"])
+            if record["parent"] is None:
+                self.back_propogate(node, record["reward"])
+            else:
+                if self.simulated_index is not None:
+                    self.simulated_index.add(scenario)
+                self.record_result(node, record["reward"], record["min_distance"], test_case)
+                # a transposition's first record is its reuse (or it was simulated afterwards anyway)
+                node.reused = node.stats.state is not node.state
+            self.iterations = record["iterations"]
+            self.count = record["count"]
+            CheckpointJournal.restore_rng(record)
+        self.journal = journal
+        logger.info(f"resumed {len(records)} simulations from {checkpoint}, {self.iterations} iterations done")
+
+    def generate(self, budget: int) -> List[TestCase]:
+        """budget is the number of search iterations (screening simulations if screen_speed is set)"""
+        for test_case in self.iter_generate(budget):
+            pass
+        render_plots(self.test_cases)
+        return self.test_cases
+
+    def iter_generate(self, budget: int) -> Iterator[TestCase]:
+        """Run the search, yielding each kept test case as soon as it is found
+        (test cases restored by resume() are not yielded again)"""
+        if self.root.visits == 0:
+            reward, distance, test_case = self.simulate(self.root.state, iteration=0, node=self.root.id)
+            self.back_propogate(self.root, reward)
+            if self.journal is not None:
+                self.journal.record_simulation(self.root, None, self.iterations, self.count, reward, distance, test_case)
+        search_budget = budget - self.refine_budget
+        if self.workers > 1:
+            yield from self.parallel_search(search_budget)
+        else:
+            while self.iterations < search_budget:
+                test_case = self.search()
+                if test_case is not None:
+                    yield test_case
+        if self.refine_budget > 0:
+            yield from self.refine(budget)
+        if self.surrogate is not None:
+            logger.info(f"surrogate skipped {self.surrogate.skipped} candidates, "
+                        f"mean absolute error: {self.surrogate.mean_absolute_error():.2f}")
+        if self.evaluator is not None:
+            logger.info(f"{self.evaluator.confirmations} confirmation simulations, "
+                        f"screening/confirmation correlation: {self.evaluator.correlation():.2f}")
+            telemetry.gauge("confirmations", self.evaluator.confirmations)
+            telemetry.gauge("fidelity_correlation", self.evaluator.correlation())
+        if trajectory_store.max_bytes > 0:
+            logger.info(f"trajectory memory: {trajectory_store.stats()}")
+        if self.journal is not None:
+            self.journal.close()
+        telemetry.close()
+
+    def near_misses(self) -> List[Node]:
+        """Simulated nodes still in the tree that came within 0.25-1.5 m of an obstacle, closest first"""
+        nodes = []
+        stack = [self.root]
+        while len(stack) != 0:
+            node = stack.pop()
+            stack.extend(node.children)
+            if node.stats.result is not None and node.score in [1, 2] and not node.state.flight_lost():
+                nodes.append(node)
+        return sorted(nodes, key=lambda node: abs(node.stats.result[1]))
+
+    def refine(self, budget: int) -> Iterator[TestCase]:
+        """Run a pattern search over the last obstacle of each near-miss, closest first, until budget iterations
+        are done. The polled scenarios become siblings of the near-miss, like sibling modifications in expand,
+        and are scored and kept like any other simulation. Sequential, whatever the number of workers"""
+        simulations, failures = 0, 0
+        for seed in self.near_misses():
+            if self.iterations >= budget:
+                break
+            if seed.parent is None:
+                continue
+            search = PatternSearch(seed.state, abs(seed.stats.result[1]), self.refine_evaluations)
+            while self.iterations < budget:
+                try:
+                    state = search.ask()
+                except TrajectoryLost as e:
+                    logger.warning(f"refinement of node {seed.id} stopped: {e}")
+                    break
+                if state is None:
+                    break
+                if self.simulated_index is not None and self.simulated_index.is_duplicate(state.scenario):
+                    telemetry.count("duplicate_skips")
+                    continue
+                node = self.add_child(seed.parent, state)
+                if self.reuse(node) is not None:
+                    test_case = self.record_result(node, *node.stats.result)
+                else:
+                    if self.simulated_index is not None:
+                        self.simulated_index.add(state.scenario)
+                    self.iterations += 1
+                    simulations += 1
+                    telemetry.count("refinement_simulations")
+                    reward, min_distance, test_case = self.simulate(state, iteration=self.iterations, node=node.id)
+                    test_case = self.record_result(node, reward, min_distance, test_case)
+                search.tell(node.state, abs(node.stats.result[1]))
+                if test_case is not None:
+                    yield test_case
+            if search.distance < search.failure_distance:
+                failures += 1
+                telemetry.count("refined_failures")
+        logger.info(f"refinement: {simulations} simulations, {failures} near-misses turned into failures")
+
+    def best_child(self, node):
+        # UCB1, with pending simulations counted as visits with the worst reward (virtual loss)
+        children = [child for child in node.children if child.visits > 0 and child not in self.in_flight]
+        if len(children) == 0:
+            return None
+        parent_visits = node.visits + node.pending
+        return max(children, key=lambda child: (child.reward - self.virtual_loss * child.pending) / (child.visits + child.pending) +
+                                             self.exploration_rate * math.sqrt(2 * math.log(parent_visits) / (child.visits + child.pending)))
+
+
+if __name__ == '__main__':
+    generator = MCTS("case_studies/mission2.yaml")
+    generator.generate(200)
@@ -0,0 +1,42 @@
+import copy
+import os
+import threading
+from typing import List
+from aerialist.px4.drone_test import DroneTest
+from aerialist.px4.obstacle import Obstacle
+
+
+def instantiate(template: DroneTest, obstacles: List[Obstacle]) -> DroneTest:
+    """A test with the given obstacles that shares the template's read-only configuration:
+    only the parts a test case changes (the drone and simulation settings) are copied, shallowly"""
+    test = copy.copy(template)
+    test.drone = copy.copy(template.drone)
+    test.simulation = copy.copy(template.simulation)
+    test.simulation.obstacles = obstacles
+    return test
+
+
+class MissionContext(object):
+    """Everything about a mission that does not depend on the obstacles, built once per run and shared by
+    all the generators and states: the parsed DroneTest and the obstacle-free (nominal) trajectory of the
+    root simulation"""
+
+    _contexts = {}
+    _lock = threading.Lock()
+
+    def __init__(self, mission_yaml: str):
+        self.mission_yaml = mission_yaml
+        self.template = DroneTest.from_yaml(mission_yaml)
+        self.nominal = None
+
+    @classmethod
+    def get(cls, mission_yaml: str):
+        path = os.path.abspath(mission_yaml)
+        with cls._lock:
+            if path not in cls._contexts:
+                cls._contexts[path] = MissionContext(path)
+            return cls._contexts[path]
+
+    def set_nominal(self, track):
+        """Keep the root's trajectory (a CompactTrajectory)"""
+        self.nominal = track
@@ -0,0 +1,89 @@
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from typing import Callable, List
+from decouple import config
+from aerialist.px4.drone_test import DroneTest, DroneTestResult
+from cache import trajectory_to_list, trajectory_from_list
+from telemetry import telemetry
+from testcase import TestCase
+
+# async: render kept test cases in background processes, end: render them after the run, none: no plots
+PLOTS = config("PLOTS", default="async")
+PLOT_PROCESSES = config("PLOT_PROCESSES", default=2, cast=int)
+
+logger = logging.getLogger(__name__)
+
+
+def use_headless_backend():
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def render(test_yaml: str, trajectory: list, log_file: str) -> str:
+    """Plot a test in a worker process; the test is passed as a yaml file, since aerialist's objects do not pickle"""
+    test = DroneTest.from_yaml(test_yaml)
+    os.remove(test_yaml)
+    return DroneTest.plot(test, [DroneTestResult(log_file=log_file, record=trajectory_from_list(trajectory))])
+
+
+class PlotRenderer(object):
+    """Renders the plots of the kept test cases off the search's critical path"""
+
+    def __init__(self, mode: str = PLOTS, processes: int = PLOT_PROCESSES):
+        self.mode = mode
+        self.processes = processes
+        self.executor = None
+        self.futures = []
+        self.deferred = []
+        self.lock = threading.Lock()
+
+    def submit(self, test_case: TestCase, callback: Callable = None) -> bool:
+        """Schedule the plot of the test case; callback(test_case) runs once it is rendered
+        (plot_file stays None if plotting failed). Return False if no plot will be rendered"""
+        if self.mode == "none":
+            return False
+        if self.mode == "end":
+            self.deferred.append((test_case, callback))
+        else:
+            self.render_async(test_case, callback)
+        return True
+
+    def render_async(self, test_case: TestCase, callback: Callable = None):
+        with self.lock, telemetry.span("plot"):
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.processes, initializer=use_headless_backend)
+            test_yaml = tempfile.mkstemp(suffix=".yaml")[1]
+            test_case.save_yaml(test_yaml)
+            future = self.executor.submit(render, test_yaml, trajectory_to_list(test_case.trajectory), test_case.log_file)
+            self.futures.append(future)
+        future.add_done_callback(lambda f: self.rendered(test_case, f, callback))
+
+    def rendered(self, test_case: TestCase, future, callback: Callable):
+        try:
+            test_case.set_plot_file(future.result())
+        except Exception as e:
+            logger.warning(f"plotting failed: {e}")
+        if callback is not None:
+            callback(test_case)
+
+    def finish(self):
+        """Render the deferred plots and wait for all of them"""
+        deferred, self.deferred = self.deferred, []
+        for test_case, callback in deferred:
+            self.render_async(test_case, callback)
+        wait(self.futures)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def render_plots(test_cases: List[TestCase], mode: str = PLOTS):
+    """Plot the given test cases in parallel and wait for them"""
+    renderer = PlotRenderer(mode)
+    for test_case in test_cases:
+        if test_case.plot_file is None:
+            renderer.submit(test_case)
+    renderer.finish()
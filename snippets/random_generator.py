@@ -1,9 +1,17 @@
-import random
-from typing import List
-from aerialist.px4.drone_test import DroneTest
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterator, List
+import numpy as np
 from aerialist.px4.obstacle import Obstacle
+import geometry
+from plotting import render_plots
+from rng import np_rng, rng
+from scenarioState import ScenarioState
+from similarity import ScenarioIndex
 from testcase import TestCase
 
+logger = logging.getLogger(__name__)
+
 
 class RandomGenerator(object):
     min_size = Obstacle.Size(2, 2, 15)
@@ -11,39 +19,127 @@ class RandomGenerator(object):
     min_position = Obstacle.Position(5, 5, 0, 0)
     max_position = Obstacle.Position(50, 50, 0, 90)
 
-    def __init__(self, case_study_file: str) -> None:
-        self.case_study = DroneTest.from_yaml(case_study_file)
+    def __init__(self, case_study_file: str, duplicate_tolerance: float = 0.2, max_retries: int = 5,
+                 batch_size: int = 0, workers: int = 1, corridor_width: float = 5.0, no_go_radius: float = 3.0) -> None:
+        self.root = ScenarioState(case_study_file)
+        self.context = self.root.context
+        self.case_study = self.context.template
+        # near-duplicates of earlier samples are re-drawn (up to max_retries times) instead of simulated
+        self.index = ScenarioIndex(duplicate_tolerance, duplicate_tolerance) if duplicate_tolerance is not None else None
+        self.max_retries = max_retries
 
-    def generate(self, budget: int) -> List[TestCase]:
-        test_cases = []
-        for i in range(budget):
-            size = Obstacle.Size(
-                l=random.uniform(self.min_size.l, self.max_size.l),
-                w=random.uniform(self.min_size.w, self.max_size.w),
-                h=random.uniform(self.min_size.h, self.max_size.h),
-            )
-            position = Obstacle.Position(
-                x=random.uniform(self.min_position.x, self.max_position.x),
-                y=random.uniform(self.min_position.y, self.max_position.y),
-                z=0,  # obstacles should always be place on the ground
-                r=random.uniform(self.min_position.r, self.max_position.r),
-            )
-            obstacle = Obstacle(size, position)
-            test = TestCase(self.case_study, [obstacle])
-            try:
-                test.execute()
-                distances = test.get_distances()
-                print(f"minimum_distance:{min(distances)}")
-                test.plot()
-                test_cases.append(test)
-            except Exception as e:
-                print("Exception during test execution, skipping the test")
-                print(e)
+        # batch mode (batch_size > 0): candidates are drawn batch_size at a time, and only those within corridor_width
+        # of the nominal flight and clear of the no-go region (no_go_radius around its start and end) are simulated,
+        # up to `workers` at once
+        self.batch_size = batch_size
+        self.workers = workers
+        self.corridor_width = corridor_width
+        self.no_go_radius = no_go_radius
+        self.rejected = 0
 
+    def generate(self, budget: int) -> List[TestCase]:
         ### You should only return the test cases
         ### that are needed for evaluation (failing or challenging ones)
+        test_cases = list(self.iter_generate(budget))
+        render_plots(test_cases)
         return test_cases
 
+    def iter_generate(self, budget: int) -> Iterator[TestCase]:
+        """Yield each test case as soon as it is simulated"""
+        if self.batch_size > 0:
+            yield from self.iter_generate_batch(budget)
+            return
+        for i in range(budget):
+            obstacle = self.sample_obstacle()
+            for retry in range(self.max_retries):
+                if self.index is None or not self.index.is_duplicate([obstacle]):
+                    break
+                obstacle = self.sample_obstacle()
+            if self.index is not None:
+                self.index.add([obstacle])
+            test = TestCase(self.case_study, [obstacle])
+            if self.execute(test):
+                yield test
+
+    def iter_generate_batch(self, budget: int) -> Iterator[TestCase]:
+        """Simulate budget pre-filtered candidates, `workers` at a time, yielding each test case as it completes"""
+        if self.context.nominal is None:
+            # the obstacle-free flight, shared with any other generator of this mission
+            self.root.get_reward()
+            if self.context.nominal is None:
+                logger.warning("the obstacle-free flight could not be simulated, random batches are not filtered")
+        candidates = []
+        futures = {}
+        started = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while started < budget or len(futures) != 0:
+                while started < budget and len(futures) < self.workers:
+                    if len(candidates) == 0:
+                        candidates = self.sample_batch()
+                        if len(candidates) == 0:
+                            logger.warning("no random candidate near the nominal flight, stopping early")
+                            budget = started
+                        continue
+                    obstacle = candidates.pop()
+                    if self.index is not None:
+                        if self.index.is_duplicate([obstacle]):
+                            continue
+                        self.index.add([obstacle])
+                    test = TestCase(self.case_study, [obstacle])
+                    futures[executor.submit(self.execute, test)] = test
+                    started += 1
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    test = futures.pop(future)
+                    if future.result():
+                        yield test
+        logger.info(f"random batches: {started} candidates simulated, {self.rejected} rejected before simulation")
+
+    @staticmethod
+    def execute(test: TestCase) -> bool:
+        try:
+            test.execute()
+            distances = test.get_distances()
+            logger.info(f"minimum_distance:{min(distances)}")
+            return True
+        except Exception as e:
+            logger.warning(f"exception during test execution, skipping the test: {e}")
+            return False
+
+    def sample_batch(self) -> List[Obstacle]:
+        """Draw batch_size obstacles at once and keep those near the nominal flight and out of the no-go region
+        (all of them if there is no nominal flight)"""
+        count = self.batch_size
+        low = [self.min_position.x, self.min_position.y, self.min_size.l, self.min_size.w, self.min_size.h, self.min_position.r]
+        high = [self.max_position.x, self.max_position.y, self.max_size.l, self.max_size.w, self.max_size.h, self.max_position.r]
+        samples = np_rng().uniform(low, high, (count, 6))
+        x, y, l, w, h, r = samples.T
+        rectangles = np.column_stack([x, y, l, w, r])
+        nominal = self.context.nominal.points_2d() if self.context.nominal is not None else np.empty((0, 2))
+        if len(nominal) == 0:
+            keep = np.arange(count)
+        else:
+            near = geometry.clearance_matrix(nominal, rectangles).min(axis=0) <= self.corridor_width
+            no_go = geometry.clearance_matrix(nominal[[0, -1]], rectangles).min(axis=0) < self.no_go_radius
+            keep = np.flatnonzero(near & ~no_go)
+        self.rejected += count - len(keep)
+        return [Obstacle(Obstacle.Size(l=l, w=w, h=h), Obstacle.Position(x=x, y=y, z=0, r=r))
+                for x, y, l, w, h, r in samples[keep].tolist()]
+
+    def sample_obstacle(self) -> Obstacle:
+        size = Obstacle.Size(
+            l=rng().uniform(self.min_size.l, self.max_size.l),
+            w=rng().uniform(self.min_size.w, self.max_size.w),
+            h=rng().uniform(self.min_size.h, self.max_size.h),
+        )
+        position = Obstacle.Position(
+            x=rng().uniform(self.min_position.x, self.max_position.x),
+            y=rng().uniform(self.min_position.y, self.max_position.y),
+            z=0,  # obstacles should always be place on the ground
+            r=rng().uniform(self.min_position.r, self.max_position.r),
+        )
+        return Obstacle(size, position)
+
 
 if __name__ == "__main__":
     generator = RandomGenerator("case_studies/mission1.yaml")
@@ -0,0 +1,109 @@
+import logging
+from typing import Optional
+import numpy as np
+from aerialist.px4.obstacle import Obstacle
+import geometry
+from scenarioState import ScenarioState
+
+logger = logging.getLogger(__name__)
+
+# initial poll step for the last obstacle's (x, y, l, w, r), in meters and degrees
+STEPS = np.array([1.0, 1.0, 1.0, 1.0, 10.0])
+# the search stops once the step has been halved this many times without an improvement
+MAX_HALVINGS = 3
+# shortest side a poll may give the obstacle, in meters
+MIN_SIDE = 1.0
+
+
+class PatternSearch(object):
+    """Compass search over the last obstacle (x, y, l, w, r) of a near-miss scenario, driven with ask/tell:
+    ask() returns the next scenario to simulate, tell() its min distance. The polls around the incumbent are
+    ordered by their clearance to the incumbent's flight (closest first, the last successful direction before
+    them), the step is halved after a round without improvement, and the search ends on a failure
+    (min distance below failure_distance), after max_evaluations simulations or when the step is too small.
+    Polls keep the obstacle inside the placement area and off the other obstacles, like the generator does"""
+
+    def __init__(self, state: ScenarioState, distance: float, max_evaluations: int = 8,
+                 failure_distance: float = 0.25, steps: np.ndarray = STEPS):
+        self.incumbent = state
+        self.distance = distance
+        self.max_evaluations = max_evaluations
+        self.failure_distance = failure_distance
+        self.steps = np.array(steps, dtype=float)
+        self.halvings = 0
+        self.evaluations = 0
+        self.rounds = 0
+        self.polls = []
+        self.improved = False
+        # direction of the last improvement, polled first, and of the poll being simulated
+        self.direction = None
+        self.pending = None
+        self.tried = {state}
+
+    @property
+    def done(self) -> bool:
+        return self.distance < self.failure_distance or self.evaluations >= self.max_evaluations or \
+            self.halvings > MAX_HALVINGS
+
+    def ask(self) -> Optional[ScenarioState]:
+        while not self.done:
+            if len(self.polls) == 0:
+                if self.rounds != 0 and not self.improved:
+                    # the last round found nothing better: poll again at half the step
+                    self.steps /= 2
+                    self.halvings += 1
+                    if self.done:
+                        break
+                self.rounds += 1
+                self.improved = False
+                self.polls = self.poll()
+                continue
+            self.pending, state = self.polls.pop(0)
+            self.tried.add(state)
+            return state
+        return None
+
+    def tell(self, state: ScenarioState, distance: float):
+        self.evaluations += 1
+        if distance < self.distance:
+            logger.debug(f"refinement improved the min distance from {self.distance:.2f} to {distance:.2f}")
+            self.incumbent = state
+            self.distance = distance
+            self.direction = self.pending
+            self.improved = True
+            # poll around the new incumbent
+            self.polls = []
+
+    def poll(self):
+        """Feasible (direction, state) pairs around the incumbent, in polling order"""
+        last = self.incumbent.scenario[-1]
+        others = self.incumbent.scenario[:-1]
+        values = np.array([last.position.x, last.position.y, last.size.l, last.size.w, last.position.r])
+        candidates = []
+        for dimension in range(len(values)):
+            for sign in [1, -1]:
+                moved = values.copy()
+                moved[dimension] += sign * self.steps[dimension]
+                moved[4] %= 180
+                if not self.feasible(moved, others):
+                    continue
+                x, y, l, w, r = moved.tolist()
+                obstacle = Obstacle(Obstacle.Size(l, w, last.size.h), Obstacle.Position(x, y, 0, r))
+                state = self.incumbent.child(others + (obstacle,))
+                if state not in self.tried:
+                    candidates.append(((dimension, sign), state, moved))
+        if len(candidates) == 0:
+            return []
+        # clearance of the incumbent's flight to each moved obstacle
+        clearances = geometry.clearance_matrix(self.incumbent.trajectory_2d, [moved for _, _, moved in candidates])
+        predictions = clearances.min(axis=0) if len(clearances) != 0 else np.zeros(len(candidates))
+        order = sorted(range(len(candidates)), key=lambda i: (candidates[i][0] != self.direction, predictions[i]))
+        return [candidates[i][:2] for i in order]
+
+    def feasible(self, values: np.ndarray, others) -> bool:
+        """The obstacle's circumscribed circle stays inside the placement area and off the other obstacles"""
+        x, y, l, w, r = values
+        if not (MIN_SIDE <= l <= ScenarioState.max_size.l and MIN_SIDE <= w <= ScenarioState.max_size.w):
+            return False
+        radius = geometry.free_radii([(x, y)], self.incumbent.bounds(), self.incumbent.rectangles(others))[0]
+        return bool(np.hypot(l, w) / 2 <= radius)
@@ -0,0 +1,22 @@
+import random
+import threading
+import numpy as np
+
+_local = threading.local()
+
+
+def seed_thread(seed: int):
+    """Give the calling thread its own random streams, so generators running side by side in other threads
+    (campaign jobs) neither disturb nor depend on each other's draws"""
+    _local.random = random.Random(seed)
+    _local.numpy = np.random.RandomState(seed)
+
+
+def rng():
+    """The calling thread's random.Random, or the random module's shared one if the thread was not seeded"""
+    return getattr(_local, "random", random)
+
+
+def np_rng():
+    """The calling thread's numpy RandomState, or numpy's global one if the thread was not seeded"""
+    return getattr(_local, "numpy", np.random)
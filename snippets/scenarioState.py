@@ -1,239 +1,311 @@
-import os
-import random
-import logging
-import math
-import numpy as np
-import pandas
-import subprocess
-from copy import deepcopy
-from typing import List
-from aerialist.px4.drone_test import DroneTest
-from aerialist.px4.obstacle import Obstacle
-from testcase import TestCase
-from utils import random_nonintersecting_rectangle, get_boundary_distance, random_rectangle, plot_rectangle, circle_coverage, random_nonintersecting_circle
-
-
-class ScenarioState:
-    min_size = Obstacle.Size(2, 2, 10)
-    max_size = Obstacle.Size(20, 20, 25)
-
-    # fixed area: -40 < x < 30, 10 < y < 40;
-    # for the rotation, if length is larger than width, the rotation is based on x-axis; otherwise y-axis
-    min_position = Obstacle.Position(-40, 10, 0, 0)
-    max_position = Obstacle.Position(30, 40, 0, 90)
-
-    def __init__(self, mission_yaml=None, scenario: List[Obstacle] = []):
-        self.scenario = scenario
-        self.mission_yaml = os.path.join(os.path.dirname(os.path.abspath(__file__)), mission_yaml)
-
-        # drone's trajectory: [(x0,y0), (x1,y1), ...]
-        self.trajectory_2d = []
-        self.trajectory = None
-
-        self.min_reward = 0.0
-        self.max_distance = 5.0
-        self.max_obstacles = 3.0
-
-    def next_state(self):
-        """Generate a new obstacle on the path of the drone"""
-        new_obstacle = self.generate()
-        new_state = deepcopy(self)
-        if new_obstacle is not None:
-            new_state.scenario.append(new_obstacle)
-        return new_state
-
-    def random_rotation_modification(self, modified_state):
-        new_r = random.uniform(0, 90)
-        modified_position = Obstacle.Position(modified_state.scenario[-1].position.x,
-                                              modified_state.scenario[-1].position.y, 0, new_r)
-        size = Obstacle.Size(modified_state.scenario[-1].size.l, modified_state.scenario[-1].size.w, self.max_size.h)
-        modified_obstacle = Obstacle(size, modified_position)
-        modified_state.scenario.pop()
-        modified_state.scenario.append(modified_obstacle)
-        return modified_state
-
-    def projection_modification(self, modified_state):
-        original_center_x = modified_state.scenario[-1].position.x
-        original_center_y = modified_state.scenario[-1].position.y
-        closest_point, rotation, min_distance = self.find_closest_point_with_rotation(modified_state.trajectory_2d,
-                                                                                      [original_center_x,
-                                                                                       original_center_y])
-        new_center_x = (closest_point[0] + original_center_x) / 2
-        new_center_y = (closest_point[1] + original_center_y) / 2
-        last_obstacle = modified_state.scenario.pop()
-        all_other_circles = []
-        other_rectangles = [(ob.position.x, ob.position.y, ob.size.l, ob.size.w, ob.position.r) for ob in
-                            modified_state.scenario]
-        for other_rectangle in other_rectangles:
-            all_other_circles += circle_coverage(*other_rectangle, 4)
-        circle = random_nonintersecting_circle(new_center_x,
-                                               new_center_y,
-                                               self.max_position.y,
-                                               self.min_position.y,
-                                               self.min_position.x,
-                                               self.max_position.x,
-                                               all_other_circles
-                                               )
-        if circle is not None:
-            x, y, l, w, r = random_rectangle(circle[0], circle[1], min(circle[2], min_distance / 2))
-            new_l, new_w, new_r = 0, 0, 0
-            if rotation > 90.0:
-                new_r = rotation - 90
-                new_l = min(l, w)
-                new_w = max(l, w)
-            else:
-                new_r = rotation
-                new_l = max(l, w)
-                new_w = min(l, w)
-
-            size = Obstacle.Size(l=new_l, w=new_w, h=25)
-            position = Obstacle.Position(x=x, y=y, z=0, r=new_r)
-            new_obstacle = Obstacle(size, position)
-            modified_state.scenario.append(new_obstacle)
-            return modified_state
-        else:
-            modified_state.scenario.append(last_obstacle)
-            return self.random_rotation_modification(modified_state)
-
-    def random_generate_modification(self, modified_state):
-        candidate_positions = []
-        for position in modified_state.trajectory_2d:
-            if self.min_position.x < position[0] < self.max_position.x and \
-                    self.min_position.y < position[1] < self.max_position.y:
-                candidate_positions.append(position)
-
-        candidate_position = random.choice(candidate_positions)
-
-        x, y, l, w, r = random_nonintersecting_rectangle(
-            candidate_position[0],
-            candidate_position[1],
-            self.max_position.y,
-            self.min_position.y,
-            self.min_position.x,
-            self.max_position.x,
-            [(ob.position.x, ob.position.y, ob.size.l, ob.size.w, ob.position.r) for ob in self.scenario]
-        )
-        position = Obstacle.Position(x, y, 0, r)
-        size = Obstacle.Size(l, w, self.max_size.h)
-        new_obstacle = Obstacle(size, position)
-        modified_state.scenario.pop()
-        modified_state.scenario.append(new_obstacle)
-
-        return modified_state
-
-    def modify_state(self):
-        modified_state = deepcopy(self)
-        return self.projection_modification(modified_state)
-
-    def get_reward(self):
-        """Simulate the scenario and calculate the reward"""
-        test = TestCase(DroneTest.from_yaml(self.mission_yaml), self.scenario)
-        try:
-            self.trajectory = test.execute()
-            self.trajectory_2d = [(position.x, position.y) for position in self.trajectory.positions]
-        except Exception as e:
-            return self.min_reward, self.max_distance, test
-
-        if len(self.scenario) == 0:
-            return self.min_reward, self.max_distance, test
-
-        min_distance = min(test.get_distances())
-        reward = -1.0 * min_distance
-        test.plot()
-        return reward, min_distance, test
-
-    def is_terminal(self):
-        if len(self.scenario) == 3:
-            return True
-        return False
-
-    def check_min_distance_to_last_obstacle(self) -> bool:
-        min_distance = min([
-            self.trajectory.min_distance_to_obstacles([obst])
-            for obst in self.scenario
-        ])
-        if min_distance == self.trajectory.min_distance_to_obstacles([self.scenario[-1]]):
-            return True
-        return False
-
-    def generate(self):
-        """Randomly choose a point on the drone's trajectory, as the center point of the new rectangle"""
-        candidate_positions = []
-        for position in self.trajectory_2d:
-            if len(self.scenario) == 0 and \
-                    position[1] > self.min_position.y + 1/6 * (self.max_position.y - self.min_position.y):
-                break
-            if self.min_position.x < position[0] < self.max_position.x and \
-                    self.min_position.y < position[1] < self.max_position.y:
-                candidate_positions.append(position)
-
-        candidate_position = random.choice(candidate_positions)
-        if len(self.scenario) == 0:
-            radius = get_boundary_distance(
-                            candidate_position[0],
-                            candidate_position[1],
-                            self.max_position.y,
-                            self.min_position.y,
-                            self.min_position.x,
-                            self.max_position.x
-                        )
-            x, y, l, w, r = random_rectangle(candidate_position[0], candidate_position[1], radius)
-        else:
-            x, y, l, w, r = random_nonintersecting_rectangle(
-                                candidate_position[0],
-                                candidate_position[1],
-                                self.max_position.y,
-                                self.min_position.y,
-                                self.min_position.x,
-                                self.max_position.x,
-                                [(ob.position.x, ob.position.y, ob.size.l, ob.size.w, ob.position.r) for ob in self.scenario]
-                            )
-        position = Obstacle.Position(x, y, 0, r)
-        size = Obstacle.Size(l, w, self.max_size.h)
-        return Obstacle(size, position)
-
-    @staticmethod
-    def find_closest_point_with_rotation(trajectory_2d, original_center_point):
-        trajectory_2d = np.array(trajectory_2d)
-        original_center_point = np.array(original_center_point)
-        distances = np.linalg.norm(trajectory_2d[:, :2] - original_center_point[:2], axis=1)
-        min_index = np.argmin(distances)
-        min_distance = distances[min_index]
-        closest_point = trajectory_2d[min_index]
-        vector_to_closest_point = closest_point - original_center_point
-        x_axis = np.array([1, 0])  # x-axis unit vector in 2D
-        dot_product = np.dot(vector_to_closest_point, x_axis)
-
-        # Get the magnitudes of the vectors
-        magnitude_projected_vector = np.linalg.norm(vector_to_closest_point)
-        magnitude_x_axis = np.linalg.norm(x_axis)  # This is 1, but we'll include it for completeness
-        angle_radians = np.arccos(dot_product / (magnitude_projected_vector * magnitude_x_axis))
-        angle_degrees = math.degrees(angle_radians)
-
-        return closest_point, angle_degrees, min_distance
-
-    def __eq__(self, other):
-        list1 = [str(obstacle.to_dict()) for obstacle in self.scenario]
-        list2 = [str(obstacle.to_dict()) for obstacle in other.scenario]
-        return set(list1) == set(list2)
-
-    def __str__(self):
-        s = ""
-        for ob in self.scenario:
-            s += str((ob.position.x, ob.position.y, ob.size.l, ob.size.w, ob.position.r)) + '\n'
-        return s
-
-
-def replay(obstacles):
-    state = ScenarioState()
-    for obst in obstacles:
-        position = Obstacle.Position(obst[0], obst[1], 0, obst[4])
-        size = Obstacle.Size(obst[2], obst[3], 25)
-        state.scenario.append(Obstacle(size, position))
-    state.get_reward()
-
-
-if __name__ == '__main__':
-    pass
-
-
+import os
+import logging
+import math
+import numpy as np
+import pandas
+import subprocess
+from typing import Sequence
+from aerialist.px4.drone_test import DroneTest
+from aerialist.px4.obstacle import Obstacle
+from aerialist.px4.trajectory import Trajectory
+from testcase import TestCase
+from cache import canonical_order, canonical_scenario
+import geometry
+from spatial_index import TrajectoryIndex
+from trajectory_store import CompactTrajectory
+from mission_context import MissionContext
+from rng import rng
+from telemetry import telemetry
+from utils import random_rectangle, plot_rectangle
+
+
+class ScenarioState:
+    # states are immutable once simulated: obstacles are kept in a tuple and a child state
+    # references its parent's trajectory data until it is simulated itself
+    __slots__ = ("context", "scenario", "track", "clearances", "canonical")
+
+    min_size = Obstacle.Size(2, 2, 10)
+    max_size = Obstacle.Size(20, 20, 25)
+
+    # fixed area: -40 < x < 30, 10 < y < 40;
+    # for the rotation, if length is larger than width, the rotation is based on x-axis; otherwise y-axis
+    min_position = Obstacle.Position(-40, 10, 0, 0)
+    max_position = Obstacle.Position(30, 40, 0, 90)
+
+    # number of candidate centers evaluated in one batch when placing an obstacle
+    placement_samples = 200
+
+    min_reward = 0.0
+    max_distance = 5.0
+    max_obstacles = 3.0
+
+    def __init__(self, mission_yaml=None, scenario: Sequence[Obstacle] = ()):
+        self.scenario = tuple(scenario)
+        self.canonical = None
+        self.context = MissionContext.get(os.path.join(os.path.dirname(os.path.abspath(__file__)), mission_yaml))
+
+        # drone's trajectory (see trajectory_2d), None until simulated
+        self.track = None
+        # minimum distance of the trajectory to each obstacle, see obstacle_distances
+        self.clearances = None
+
+    def child(self, scenario: Sequence[Obstacle]):
+        """A state with the given obstacles, sharing this state's mission and trajectory data until it is simulated"""
+        state = ScenarioState.__new__(ScenarioState)
+        state.context = self.context
+        state.scenario = tuple(scenario)
+        state.canonical = None
+        state.track = self.track
+        state.clearances = None
+        return state
+
+    def adopt(self, other):
+        """Take over the simulation results of an equivalent state"""
+        self.track = other.track
+        self.clearances = None
+        if other.clearances is not None:
+            # the same obstacles, possibly in another order: map the clearances through the canonical order
+            self.clearances = np.empty_like(other.clearances)
+            self.clearances[canonical_order(self.scenario)] = other.clearances[canonical_order(other.scenario)]
+
+    @property
+    def mission_yaml(self) -> str:
+        return self.context.mission_yaml
+
+    @property
+    def trajectory(self) -> Trajectory:
+        return self.track.to_trajectory() if self.track is not None else None
+
+    @property
+    def trajectory_2d(self) -> np.ndarray:
+        """drone's trajectory: [[x0,y0], [x1,y1], ...] (float32), reloaded if it was evicted"""
+        return self.track.points_2d() if self.track is not None else np.empty((0, 2), dtype=np.float32)
+
+    def next_state(self):
+        """Generate a new obstacle on the path of the drone"""
+        new_obstacle = self.generate()
+        if new_obstacle is None:
+            return self.child(self.scenario)
+        return self.child(self.scenario + (new_obstacle,))
+
+    def random_rotation_modification(self, modified_state):
+        new_r = rng().uniform(0, 90)
+        modified_position = Obstacle.Position(modified_state.scenario[-1].position.x,
+                                              modified_state.scenario[-1].position.y, 0, new_r)
+        size = Obstacle.Size(modified_state.scenario[-1].size.l, modified_state.scenario[-1].size.w, self.max_size.h)
+        modified_obstacle = Obstacle(size, modified_position)
+        return modified_state.child(modified_state.scenario[:-1] + (modified_obstacle,))
+
+    def projection_modification(self, modified_state):
+        original_center_x = modified_state.scenario[-1].position.x
+        original_center_y = modified_state.scenario[-1].position.y
+        closest_point, rotation, min_distance = self.find_closest_point_with_rotation(modified_state.trajectory_index(),
+                                                                                      [original_center_x,
+                                                                                       original_center_y])
+        other_obstacles = modified_state.scenario[:-1]
+        # candidate centers around the midpoint between the obstacle and the trajectory
+        steps = np.linspace(0.25, 0.75, self.placement_samples)[:, None]
+        centers = (1 - steps) * np.array([original_center_x, original_center_y]) + steps * np.asarray(closest_point)
+        with telemetry.span("placement"):
+            radii = geometry.free_radii(centers, self.bounds(), self.rectangles(other_obstacles))
+        # keep the obstacle off the trajectory: its circle may reach the closest point, not beyond
+        radii = np.minimum(rng().uniform(0.5, 0.9) * radii, np.linalg.norm(np.asarray(closest_point) - centers, axis=1))
+        best = int(np.argmax(radii))
+        circle = (float(centers[best, 0]), float(centers[best, 1]), float(radii[best])) if radii[best] > 0 else None
+        if circle is not None:
+            x, y, l, w, r = random_rectangle(*circle)
+            new_l, new_w, new_r = 0, 0, 0
+            if rotation > 90.0:
+                new_r = rotation - 90
+                new_l = min(l, w)
+                new_w = max(l, w)
+            else:
+                new_r = rotation
+                new_l = max(l, w)
+                new_w = min(l, w)
+
+            size = Obstacle.Size(l=new_l, w=new_w, h=25)
+            position = Obstacle.Position(x=x, y=y, z=0, r=new_r)
+            new_obstacle = Obstacle(size, position)
+            return modified_state.child(other_obstacles + (new_obstacle,))
+        else:
+            return self.random_rotation_modification(modified_state)
+
+    def random_generate_modification(self, modified_state):
+        candidate_positions = modified_state.candidate_positions()
+
+        other_obstacles = modified_state.scenario[:-1]
+        placement = modified_state.sample_placement(candidate_positions, other_obstacles)
+        if placement is None:
+            return modified_state
+        center_x, center_y, radius = placement
+        x, y, l, w, r = random_rectangle(center_x, center_y, rng().uniform(0.5, 0.9) * radius)
+        position = Obstacle.Position(x, y, 0, r)
+        size = Obstacle.Size(l, w, self.max_size.h)
+        return modified_state.child(other_obstacles + (Obstacle(size, position),))
+
+    def modify_state(self):
+        return self.projection_modification(self)
+
+    def get_reward(self, speed: float = None, use_cache: bool = True):
+        """Simulate the scenario (at the given simulation speed, the mission's by default) and calculate the reward;
+        without use_cache, the scenario is flown again even if the simulation cache has it"""
+        test = TestCase(self.context.template, list(self.scenario))
+        if speed is not None:
+            test.test.simulation.speed = speed
+        try:
+            # an expandable state's flight is the basis of its children's obstacles, so it is only cut short
+            # by a hard failure (pruned anyway), never once it passed the obstacles
+            self.set_trajectory(test.execute(stop_when_passed=self.is_terminal(), use_cache=use_cache), test.test, test.log_file)
+        except Exception as e:
+            return self.min_reward, self.max_distance, test
+
+        if len(self.scenario) == 0:
+            return self.min_reward, self.max_distance, test
+
+        self.clearances = np.array(test.get_distances())
+        min_distance = float(self.clearances.min())
+        reward = -1.0 * min_distance
+        return reward, min_distance, test
+
+    def set_trajectory(self, trajectory: Trajectory, test: DroneTest = None, log_file: str = None):
+        """Keep the flight compactly; test (for the simulation cache) and log_file are where it is reloaded from if evicted"""
+        self.track = CompactTrajectory(trajectory, test, log_file)
+        self.clearances = None
+        if len(self.scenario) == 0:
+            self.context.set_nominal(self.track)
+
+    def flight_lost(self) -> bool:
+        """Whether the flight was evicted from memory and could not be reloaded (see CompactTrajectory)"""
+        return self.track is not None and self.track.lost
+
+    def is_terminal(self):
+        if len(self.scenario) == 3:
+            return True
+        return False
+
+    def obstacle_distances(self) -> np.ndarray:
+        """Minimum distance of the trajectory to each obstacle, computed once per simulation"""
+        if self.clearances is None:
+            self.clearances = geometry.min_clearances(self.trajectory_2d, self.rectangles())
+        return self.clearances
+
+    def check_min_distance_to_last_obstacle(self) -> bool:
+        distances = self.obstacle_distances()
+        return bool(distances.min() == distances[-1])
+
+    def generate(self):
+        """Randomly choose a point on the drone's trajectory, as the center point of the new rectangle"""
+        index = self.trajectory_index()
+        candidates = self.candidate_indices()
+        if len(self.scenario) == 0:
+            # the first obstacle goes on the beginning of the flight, before it leaves the first sixth of the area
+            cutoff = index.first_above(1, self.min_position.y + 1/6 * (self.max_position.y - self.min_position.y))
+            candidates = candidates[candidates < cutoff]
+
+        placement = self.sample_placement(index.points[candidates])
+        if placement is None:
+            return None
+        center_x, center_y, radius = placement
+        if len(self.scenario) == 0:
+            x, y, l, w, r = random_rectangle(center_x, center_y, radius)
+        else:
+            x, y, l, w, r = random_rectangle(center_x, center_y, rng().uniform(0.5, 0.9) * radius)
+        position = Obstacle.Position(x, y, 0, r)
+        size = Obstacle.Size(l, w, self.max_size.h)
+        return Obstacle(size, position)
+
+    def sample_placement(self, candidate_positions, obstacles: Sequence[Obstacle] = None):
+        """Evaluate up to placement_samples candidate centers in one batch, using the exact clearance
+        to the obstacles (the current ones by default), and return a random feasible (x, y, radius), or None"""
+        if len(candidate_positions) == 0:
+            return None
+        centers = np.asarray(candidate_positions, dtype=float)
+        if len(centers) > self.placement_samples:
+            centers = centers[rng().sample(range(len(centers)), self.placement_samples)]
+        with telemetry.span("placement"):
+            radii = geometry.free_radii(centers, self.bounds(), self.rectangles(obstacles))
+        feasible = np.flatnonzero(radii > 0)
+        if len(feasible) == 0:
+            return None
+        best = rng().choice(feasible)
+        return float(centers[best, 0]), float(centers[best, 1]), float(radii[best])
+
+    def trajectory_index(self) -> TrajectoryIndex:
+        """Spatial index over trajectory_2d, built once per simulated trajectory and shared with the children"""
+        if self.track is None:
+            return TrajectoryIndex(self.trajectory_2d)
+        return self.track.spatial_index()
+
+    def candidate_indices(self):
+        """Indices of the trajectory points inside the placement area, in flight order, computed once per trajectory"""
+        index = self.trajectory_index()
+        if self.track is not None and self.track.candidates is not None:
+            return self.track.candidates
+        candidates = index.inside_bounds(self.min_position.x, self.min_position.y, self.max_position.x, self.max_position.y)
+        if self.track is not None:
+            self.track.candidates = candidates
+        return candidates
+
+    def candidate_positions(self):
+        return self.trajectory_index().points[self.candidate_indices()]
+
+    def bounds(self):
+        """Placement area as (upper_b, lower_b, left_b, right_b)"""
+        return self.max_position.y, self.min_position.y, self.min_position.x, self.max_position.x
+
+    def rectangles(self, obstacles: Sequence[Obstacle] = None):
+        if obstacles is None:
+            obstacles = self.scenario
+        return geometry.obstacle_rectangles(obstacles)
+
+    @staticmethod
+    def find_closest_point_with_rotation(index: TrajectoryIndex, original_center_point):
+        original_center_point = np.array(original_center_point)
+        min_index, min_distance = index.nearest(original_center_point)
+        closest_point = index.points[min_index]
+        vector_to_closest_point = closest_point - original_center_point
+        x_axis = np.array([1, 0])  # x-axis unit vector in 2D
+        dot_product = np.dot(vector_to_closest_point, x_axis)
+
+        # Get the magnitudes of the vectors
+        magnitude_projected_vector = np.linalg.norm(vector_to_closest_point)
+        magnitude_x_axis = np.linalg.norm(x_axis)  # This is 1, but we'll include it for completeness
+        angle_radians = np.arccos(dot_product / (magnitude_projected_vector * magnitude_x_axis))
+        angle_degrees = math.degrees(angle_radians)
+
+        return closest_point, angle_degrees, min_distance
+
+    def key(self) -> tuple:
+        """Order-independent, rounded encoding of the obstacle set (see cache.canonical_scenario)"""
+        if self.canonical is None:
+            self.canonical = canonical_scenario(self.scenario)
+        return self.canonical
+
+    def __eq__(self, other):
+        return self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __str__(self):
+        s = ""
+        for ob in self.scenario:
+            s += str((ob.position.x, ob.position.y, ob.size.l, ob.size.w, ob.position.r)) + '\n'
+        return s
+
+
+def replay(mission_yaml, obstacles):
+    """Re-run a scenario given as a list of (x, y, l, w, r); served from the simulation cache if it was flown before"""
+    scenario = []
+    for obst in obstacles:
+        position = Obstacle.Position(obst[0], obst[1], 0, obst[4])
+        size = Obstacle.Size(obst[2], obst[3], 25)
+        scenario.append(Obstacle(size, position))
+    return ScenarioState(mission_yaml, scenario).get_reward()
+
+
+if __name__ == '__main__':
+    pass
+
+
@@ -0,0 +1,59 @@
+import itertools
+import threading
+from typing import Sequence
+import numpy as np
+from aerialist.px4.obstacle import Obstacle
+from cache import canonical_obstacle
+
+
+def scenario_features(obstacles: Sequence[Obstacle]) -> np.ndarray:
+    """(k, 5) rows of (x, y, l, w, r) per obstacle, with the rotation folded into [0, 90)"""
+    rows = []
+    for obst in obstacles:
+        x, y, z, l, w, h, r = canonical_obstacle(obst, precision=6)
+        rows.append((x, y, l, w, r))
+    return np.array(rows, dtype=float).reshape(-1, 5)
+
+
+class ScenarioIndex(object):
+    """Near-duplicate lookup over obstacle layouts. Two scenarios are near-duplicates if they have as many
+    obstacles and some pairing of their obstacles differs by at most position_tolerance in the centers,
+    size_tolerance in length and width, and rotation_tolerance degrees. Scenarios are bucketed by their
+    number of obstacles; a lookup compares against the whole bucket at once for each of the (at most 3!)
+    pairings, which for the few thousand scenarios of a run is faster than maintaining a tree"""
+
+    def __init__(self, position_tolerance: float = 0.2, size_tolerance: float = 0.2, rotation_tolerance: float = 5.0):
+        self.tolerance = np.array([position_tolerance, position_tolerance, size_tolerance, size_tolerance,
+                                   rotation_tolerance])
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def add(self, obstacles: Sequence[Obstacle]):
+        features = scenario_features(obstacles)
+        with self.lock:
+            bucket = self.buckets.get(len(features), np.empty((0,) + features.shape))
+            self.buckets[len(features)] = np.concatenate([bucket, features[None]])
+
+    def is_duplicate(self, obstacles: Sequence[Obstacle]) -> bool:
+        features = scenario_features(obstacles)
+        with self.lock:
+            bucket = self.buckets.get(len(features))
+        if bucket is None or len(bucket) == 0:
+            return False
+        for permutation in itertools.permutations(range(len(features))):
+            if (self.differences(bucket, features[list(permutation)]) <= 1).all(axis=(1, 2)).any():
+                return True
+        return False
+
+    def differences(self, bucket: np.ndarray, features: np.ndarray) -> np.ndarray:
+        """(n, k, 5) differences in units of the tolerances. The rotation is compared modulo 90 degrees:
+        across the fold, length and width are compared swapped"""
+        difference = np.abs(bucket - features)
+        wrapped = difference[..., 4] > 45
+        swapped = np.abs(bucket[..., [3, 2]] - features[..., [2, 3]])
+        difference[..., 2:4] = np.where(wrapped[..., None], swapped, difference[..., 2:4])
+        difference[..., 4] = np.where(wrapped, 90 - difference[..., 4], difference[..., 4])
+        return difference / self.tolerance
@@ -0,0 +1,67 @@
+import logging
+import os
+from artefacts import ArtefactManager, DiskQuotaExceeded, Manifest, get_artefacts
+from plotting import PlotRenderer
+from testcase import TestCase
+
+logger = logging.getLogger(__name__)
+
+
+class OutputSink(object):
+    """Writes each test case to the output folder as soon as it is found, then releases its flight data.
+    Plots are rendered by the renderer and linked next to the test case once they are ready.
+    Artefacts are exported by the artefact manager, within its quota, and listed in the folder's manifest.json"""
+
+    def __init__(self, folder: str, renderer: PlotRenderer = None, artefacts: ArtefactManager = None):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.renderer = renderer if renderer is not None else PlotRenderer()
+        self.artefacts = artefacts if artefacts is not None else get_artefacts()
+        self.manifest = Manifest(folder)
+        self.count = 0
+        # quota error of a plot exported from the renderer's callback, raised by the next write() or close()
+        self.error = None
+
+    def write(self, test_case: TestCase):
+        self.raise_error()
+        path = f"{self.folder}/test_{self.count}"
+        test_case.save_yaml(f"{path}.yaml")
+        self.artefacts.reserve(self.folder, os.path.getsize(f"{path}.yaml"))
+        entry = {
+            "test": os.path.basename(f"{path}.yaml"),
+            "obstacles": len(test_case.test.simulation.obstacles or []),
+            "min_distance": min(test_case.distances) if test_case.distances else None,
+            "log": None,
+            "plot": None,
+        }
+        # cached results may point to artefacts that were cleaned up in the meantime
+        if test_case.log_file is not None and os.path.isfile(test_case.log_file):
+            self.artefacts.export(test_case.log_file, f"{path}.ulg")
+            entry["log"] = os.path.basename(f"{path}.ulg")
+        self.manifest.add(entry)
+        logger.info(f"test case written: {path}.yaml")
+        self.count += 1
+        if test_case.plot_file is not None:
+            self.write_plot(test_case, path)
+        elif not self.renderer.submit(test_case, lambda rendered: self.write_plot(rendered, path)):
+            test_case.release()
+
+    def write_plot(self, test_case: TestCase, path: str):
+        try:
+            if test_case.plot_file is not None and os.path.isfile(test_case.plot_file):
+                self.artefacts.export(test_case.plot_file, f"{path}.png")
+                self.manifest.update(os.path.basename(f"{path}.yaml"), plot=os.path.basename(f"{path}.png"))
+        except DiskQuotaExceeded as e:
+            # may run in a future's callback, which would swallow it
+            self.error = e
+        finally:
+            test_case.release()
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Wait for the pending plots"""
+        self.renderer.finish()
+        self.raise_error()
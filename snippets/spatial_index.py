@@ -0,0 +1,78 @@
+import math
+import numpy as np
+
+
+class TrajectoryIndex(object):
+    """Uniform grid over the (x, y) points of a trajectory, answering nearest-point,
+    within-radius and inside-bounds queries without scanning the whole flight"""
+
+    def __init__(self, trajectory_2d, cell_size: float = 2.0):
+        self.points = np.asarray(trajectory_2d, dtype=float).reshape(-1, 2)
+        self.cell_size = cell_size
+        self.origin = self.points.min(axis=0) if len(self.points) != 0 else np.zeros(2)
+        cells = self.cell(self.points)
+        self.shape = cells.max(axis=0) + 1 if len(self.points) != 0 else np.zeros(2, dtype=int)
+        grid = {}
+        for index, cell in enumerate(map(tuple, cells.tolist())):
+            grid.setdefault(cell, []).append(index)
+        self.grid = {cell: np.array(indices) for cell, indices in grid.items()}
+
+    def __len__(self):
+        return len(self.points)
+
+    def cell(self, points):
+        return np.floor((np.asarray(points, dtype=float) - self.origin) / self.cell_size).astype(int)
+
+    def candidates(self, min_cell, max_cell):
+        """Indices of the points in the cells between min_cell and max_cell (inclusive)"""
+        low = np.maximum(min_cell, 0)
+        high = np.minimum(max_cell, self.shape - 1)
+        if (low > high).any():
+            return np.array([], dtype=int)
+        if np.prod(high - low + 1) > len(self.grid):
+            cells = [cell for cell in self.grid if low[0] <= cell[0] <= high[0] and low[1] <= cell[1] <= high[1]]
+        else:
+            cells = [(i, j) for i in range(low[0], high[0] + 1) for j in range(low[1], high[1] + 1) if (i, j) in self.grid]
+        if len(cells) == 0:
+            return np.array([], dtype=int)
+        return np.concatenate([self.grid[cell] for cell in cells])
+
+    def nearest(self, point):
+        """Index and distance of the trajectory point closest to point, or None for an empty trajectory"""
+        if len(self.points) == 0:
+            return None
+        point = np.asarray(point[:2], dtype=float)
+        center = self.cell(point)
+        # start from the first ring of cells that reaches the grid
+        ring = int(max(0, (-center).max(), (center - self.shape + 1).max()))
+        indices = self.candidates(center - ring, center + ring)
+        while len(indices) == 0:
+            ring += 1
+            indices = self.candidates(center - ring, center + ring)
+        distances = np.linalg.norm(self.points[indices] - point, axis=1)
+        # points outside the searched rings are at least ring * cell_size away
+        if distances.min() > ring * self.cell_size:
+            ring = int(math.ceil(distances.min() / self.cell_size))
+            indices = self.candidates(center - ring, center + ring)
+            distances = np.linalg.norm(self.points[indices] - point, axis=1)
+        best = int(np.argmin(distances))
+        return int(indices[best]), float(distances[best])
+
+    def within_radius(self, point, radius: float):
+        """Sorted indices of the points at most radius away from point"""
+        point = np.asarray(point[:2], dtype=float)
+        indices = self.candidates(self.cell(point - radius), self.cell(point + radius))
+        distances = np.linalg.norm(self.points[indices] - point, axis=1)
+        return np.sort(indices[distances <= radius])
+
+    def inside_bounds(self, min_x, min_y, max_x, max_y):
+        """Sorted indices of the points strictly inside the given box"""
+        indices = self.candidates(self.cell((min_x, min_y)), self.cell((max_x, max_y)))
+        points = self.points[indices]
+        inside = (min_x < points[:, 0]) & (points[:, 0] < max_x) & (min_y < points[:, 1]) & (points[:, 1] < max_y)
+        return np.sort(indices[inside])
+
+    def first_above(self, axis: int, value: float) -> int:
+        """Index of the first point whose coordinate on axis exceeds value, len(self) if there is none"""
+        above = self.points[:, axis] > value
+        return int(np.argmax(above)) if above.any() else len(self.points)
@@ -0,0 +1,49 @@
+import logging
+import math
+from typing import List
+import numpy as np
+from aerialist.px4.obstacle import Obstacle
+from geometry import rectangle_distances
+
+logger = logging.getLogger(__name__)
+
+
+class GeometricSurrogate(object):
+    """Predicts the min distance of a scenario from the parent's trajectory, without simulating it.
+    If the parent's path runs through the new obstacle, the drone has to go around it (obstruction = 1)."""
+
+    def __init__(self, threshold: float, max_retries: int = 5, obstruction_scale: float = 2.0):
+        # candidates predicted to keep more than threshold meters of clearance are skipped
+        self.threshold = threshold
+        self.max_retries = max_retries
+        self.obstruction_scale = obstruction_scale
+
+        self.skipped = 0
+        self.predictions = []  # (predicted, actual) min distances of the simulated candidates
+
+    def predict(self, trajectory_2d, scenario: List[Obstacle]):
+        """Return (predicted min distance, obstruction likelihood in [0, 1])"""
+        points = np.asarray(trajectory_2d, dtype=float)
+        distances = [
+            rectangle_distances(points, ob.position.x, ob.position.y, ob.size.l, ob.size.w, ob.position.r).min()
+            for ob in scenario
+        ]
+        min_distance = float(min(distances))
+        obstruction = math.exp(-distances[-1] / self.obstruction_scale)
+        return min_distance, obstruction
+
+    def is_interesting(self, prediction) -> bool:
+        min_distance, obstruction = prediction
+        return min_distance <= self.threshold
+
+    def record(self, prediction, actual_distance: float):
+        predicted_distance, obstruction = prediction
+        self.predictions.append((predicted_distance, actual_distance))
+        logger.info(
+            f"surrogate prediction: {predicted_distance:.2f}, obstruction: {obstruction:.2f}, actual: {actual_distance:.2f}"
+        )
+
+    def mean_absolute_error(self) -> float:
+        if len(self.predictions) == 0:
+            return 0.0
+        return float(np.mean([abs(predicted - actual) for predicted, actual in self.predictions]))
@@ -0,0 +1,127 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from decouple import config
+
+TELEMETRY_FILE = config("TELEMETRY_FILE", default="")
+
+logger = logging.getLogger(__name__)
+
+
+class Span(object):
+    __slots__ = ("telemetry", "name", "start")
+
+    def __init__(self, telemetry, name: str):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.telemetry.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Telemetry(object):
+    """Timing spans per phase and run counters, written as one JSON line per search iteration
+    and a summary at the end of the run. Spans are inclusive (select contains expand).
+    While disabled, span() returns a shared no-op and counters return immediately"""
+
+    def __init__(self):
+        self.enabled = False
+        self.file = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.iteration_seconds = defaultdict(float)
+
+    def enable(self, path: str):
+        self.file = open(path, "a")
+        self.enabled = True
+        self.reset()
+
+    def span(self, name: str):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def add_time(self, name: str, seconds: float):
+        with self.lock:
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+            self.iteration_seconds[name] += seconds
+
+    def count(self, name: str, value: int = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += value
+
+    def gauge(self, name: str, value):
+        """Keep the latest value, and the maximum as max_<name>"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[name] = value
+            self.gauges[f"max_{name}"] = max(value, self.gauges.get(f"max_{name}", value))
+
+    def end_iteration(self, **fields):
+        """Write the event of a finished iteration: the given fields, the time spent per phase since the
+        previous event, and the current counters"""
+        if not self.enabled:
+            return
+        with self.lock:
+            event = dict(fields)
+            event["time"] = time.perf_counter() - self.started
+            event["seconds"] = dict(self.iteration_seconds)
+            event["counters"] = dict(self.counters)
+            event.update(self.gauges)
+            self.iteration_seconds = defaultdict(float)
+            self.file.write(json.dumps(event) + "\n")
+            self.file.flush()
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "wall_clock": time.perf_counter() - self.started,
+                "seconds": dict(self.seconds),
+                "calls": dict(self.calls),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+            }
+
+    def close(self):
+        if not self.enabled:
+            return
+        summary = self.summary()
+        logger.info(f"telemetry summary: {summary}")
+        with self.lock:
+            self.file.write(json.dumps({"summary": summary}) + "\n")
+            self.file.close()
+            self.enabled = False
+
+
+telemetry = Telemetry()
@@ -1,49 +1,99 @@
-import copy
 import logging
 from typing import List
 from decouple import config
-from aerialist.px4.drone_test import DroneTest, AgentConfig
+from aerialist.px4.drone_test import DroneTest, DroneTestResult
 from aerialist.px4.obstacle import Obstacle
 from aerialist.px4.trajectory import Trajectory
+import geometry
+from agent_pool import get_pool
+from cache import get_cache
+from early_abort import EarlyAbortMonitor
+from mission_context import instantiate
+from telemetry import telemetry
 
-AGENT = config("AGENT", default=AgentConfig.DOCKER)
-if AGENT == AgentConfig.LOCAL:
-    from aerialist.px4.local_agent import LocalAgent
-if AGENT == AgentConfig.DOCKER:
-    from aerialist.px4.docker_agent import DockerAgent
-if AGENT == AgentConfig.K8S:
-    from aerialist.px4.k8s_agent import K8sAgent
+# stop simulations once their outcome with respect to the obstacles is settled; only the stand-in backends
+# (kinematic, replay) stream the flight, PX4 agents and remote workers always fly the whole mission
+STAND_IN_EARLY_ABORT = config("STAND_IN_EARLY_ABORT", default=False, cast=bool)
 
 logger = logging.getLogger(__name__)
 
 
 class TestCase(object):
+    early_abort = STAND_IN_EARLY_ABORT
+
     def __init__(self, casestudy: DroneTest, obstacles: List[Obstacle]):
-        self.test = copy.deepcopy(casestudy)
-        self.test.simulation.obstacles = obstacles
-
-    def execute(self) -> Trajectory:
-        if AGENT == AgentConfig.LOCAL:
-            agent = LocalAgent(self.test)
-        if AGENT == AgentConfig.DOCKER:
-            agent = DockerAgent(self.test)
-        if AGENT == AgentConfig.K8S:
-            agent = K8sAgent(self.test)
+        self.test = instantiate(casestudy, obstacles)
+        self.cached = False
+        self.distances = None
+        self.plot_file = None
+        # why the simulation was stopped early (see EarlyAbortMonitor), None if it ran the whole mission
+        self.aborted = None
+
+    def execute(self, early_abort: bool = None, stop_when_passed: bool = True, use_cache: bool = True) -> Trajectory:
+        """Run the test, or load its results from the cache (unless use_cache is False). With early_abort (the class default if None),
+        the flight is followed while it runs and stopped once its outcome is settled (see EarlyAbortMonitor);
+        the trajectory is then partial and not cached. Backends that cannot stream the flight ignore early_abort"""
+        cache = get_cache()
+        if cache is not None and use_cache:
+            entry = cache.get(self.test)
+            if entry is not None:
+                self.cached = True
+                self.load_results(entry.trajectory, entry.log_file, entry.distances, entry.plot_file)
+                return self.trajectory
+
+        if early_abort is None:
+            early_abort = self.early_abort
+        monitor = None
+        if early_abort and self.test.simulation.obstacles and get_pool().streams:
+            monitor = EarlyAbortMonitor(self.test.simulation.obstacles, stop_when_passed=stop_when_passed)
         logger.info("running the test...")
-        self.test_results = agent.run()
+        with telemetry.span("execute"):
+            self.test_results = get_pool().run(self.test, monitor)
+        if monitor is not None and monitor.reason is not None:
+            self.aborted = monitor.reason
+            telemetry.count(f"aborted_{monitor.reason}")
+            logger.info(f"test stopped early: {monitor.reason}")
         logger.info("test finished...")
         self.trajectory = self.test_results[0].record
         self.log_file = self.test_results[0].log_file
+        if cache is not None and self.aborted is None:
+            # a partial flight must not be served to runs that need the whole mission
+            cache.put(self.test, self.trajectory, self.log_file)
         return self.trajectory
 
+    def load_results(self, trajectory: Trajectory, log_file: str, distances: List[float] = None, plot_file: str = None):
+        """Restore the results of an earlier execution of this test"""
+        self.test_results = [DroneTestResult(log_file=log_file, record=trajectory)]
+        self.trajectory = trajectory
+        self.log_file = log_file
+        self.distances = distances
+        self.plot_file = plot_file
+
     def get_distances(self) -> List[float]:
-        return [
-            self.trajectory.min_distance_to_obstacles([obst])
-            for obst in self.test.simulation.obstacles
-        ]
+        """Minimum distance of the flight to each obstacle, all computed in one pass over the trajectory"""
+        if self.distances is None:
+            with telemetry.span("get_distances"):
+                points = [(position.x, position.y) for position in self.trajectory.positions]
+                rectangles = geometry.obstacle_rectangles(self.test.simulation.obstacles or [])
+                self.distances = geometry.min_clearances(points, rectangles).tolist()
+            if get_cache() is not None:
+                get_cache().update(self.test, distances=self.distances)
+        return self.distances
 
     def plot(self):
-        self.plot_file = DroneTest.plot(self.test, self.test_results)
+        if self.plot_file is None:
+            with telemetry.span("plot"):
+                self.set_plot_file(DroneTest.plot(self.test, self.test_results))
+
+    def set_plot_file(self, plot_file: str):
+        self.plot_file = plot_file
+        if get_cache() is not None:
+            get_cache().update(self.test, plot_file=plot_file)
+
+    def release(self):
+        """Drop the flight data once the test case is written out"""
+        self.test_results = None
+        self.trajectory = None
 
     def save_yaml(self, path):
         self.test.to_yaml(path)
@@ -0,0 +1,165 @@
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from decouple import config
+from aerialist.px4.drone_test import DroneTest
+from aerialist.px4.position import Position
+from aerialist.px4.trajectory import Trajectory
+from cache import get_cache
+from spatial_index import TrajectoryIndex
+
+# memory cap for the trajectories of nodes that can no longer be expanded, in MB (0 = no cap)
+TREE_MEMORY_MB = config("TREE_MEMORY_MB", default=0, cast=float)
+
+logger = logging.getLogger(__name__)
+
+
+class TrajectoryLost(RuntimeError):
+    """An evicted trajectory whose reload sources (cache entry, flight log) are gone"""
+
+
+class CompactTrajectory(object):
+    """A flight as float32 (x, y, z, r) rows and int64 timestamps, with its spatial index built on demand.
+    The data can be dropped (evict) and is reloaded from the simulation cache or the flight log (plain, or
+    gzipped by the artefact manager) when needed again. Both can disappear while the data is evicted: the
+    cache evicts old entries and the artefact policy may delete the log; the trajectory is then lost"""
+    __slots__ = ("xyzr", "timestamps", "index", "candidates", "test", "log_file", "lost")
+
+    def __init__(self, trajectory: Trajectory, test: DroneTest = None, log_file: str = None):
+        self.load(trajectory)
+        # where to reload the data from once it is evicted
+        self.test = test
+        self.log_file = log_file
+        self.lost = False
+
+    def load(self, trajectory: Trajectory):
+        positions = trajectory.positions
+        self.xyzr = np.array([(p.x, p.y, p.z, p.r) for p in positions], dtype=np.float32).reshape(-1, 4)
+        self.timestamps = np.array([p.timestamp for p in positions], dtype=np.int64)
+        self.index = None
+        # indices of the points inside the placement area, filled in by ScenarioState
+        self.candidates = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.xyzr is not None
+
+    @property
+    def reloadable(self) -> bool:
+        return (get_cache() is not None and self.test is not None) or self.log_source() is not None
+
+    def log_source(self):
+        """The flight log, or its gzipped copy, if either is still on disk"""
+        if self.log_file is None:
+            return None
+        for path in [self.log_file, f"{self.log_file}.gz"]:
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def points_2d(self) -> np.ndarray:
+        self.ensure_loaded()
+        return self.xyzr[:, :2]
+
+    def spatial_index(self) -> TrajectoryIndex:
+        self.ensure_loaded()
+        if self.index is None:
+            self.index = TrajectoryIndex(self.xyzr[:, :2])
+        return self.index
+
+    def to_trajectory(self) -> Trajectory:
+        self.ensure_loaded()
+        return Trajectory([Position(x=x, y=y, z=z, r=r, timestamp=int(t))
+                           for (x, y, z, r), t in zip(self.xyzr.tolist(), self.timestamps.tolist())])
+
+    def nbytes(self) -> int:
+        if not self.loaded:
+            return 0
+        size = self.xyzr.nbytes + self.timestamps.nbytes
+        if self.index is not None:
+            size += self.index.points.nbytes + len(self.index) * 8
+        return size
+
+    def evict(self):
+        self.xyzr = None
+        self.timestamps = None
+        self.index = None
+        self.candidates = None
+
+    def ensure_loaded(self):
+        if self.loaded:
+            trajectory_store.touch(self)
+            return
+        if self.lost:
+            raise TrajectoryLost("evicted trajectory is neither in the simulation cache nor in a flight log")
+        trajectory = None
+        cache = get_cache()
+        if cache is not None and self.test is not None:
+            entry = cache.get(self.test, count=False)
+            trajectory = entry.trajectory if entry is not None else None
+        log = self.log_source() if trajectory is None else None
+        if log is not None and log.endswith(".gz"):
+            trajectory = extract_from_gzip(log)
+        elif log is not None:
+            trajectory = Trajectory.extract_from_log(log)
+        if trajectory is None:
+            self.lost = True
+            raise TrajectoryLost("evicted trajectory is neither in the simulation cache nor in a flight log")
+        self.load(trajectory)
+        trajectory_store.reloads += 1
+        trajectory_store.release(self)
+
+
+def extract_from_gzip(path: str) -> Trajectory:
+    """Trajectory of a gzipped flight log, unpacked to a temporary file"""
+    handle, log = tempfile.mkstemp(suffix=".ulg")
+    try:
+        with os.fdopen(handle, "wb") as target, gzip.open(path, "rb") as source:
+            shutil.copyfileobj(source, target)
+        return Trajectory.extract_from_log(log)
+    finally:
+        os.remove(log)
+
+
+class TrajectoryStore(object):
+    """LRU over the trajectories of nodes that can no longer be expanded (terminal or pruned): once they take
+    more than max_bytes, the least recently used ones are evicted. Trajectories of expandable nodes are never evicted"""
+
+    def __init__(self, max_bytes: int = int(TREE_MEMORY_MB * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self.tracks = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.reloads = 0
+        self.lock = threading.Lock()
+
+    def release(self, track: CompactTrajectory):
+        """Make the trajectory evictable, and evict the least recently used ones above the cap"""
+        if self.max_bytes <= 0 or track is None or not track.loaded or not track.reloadable:
+            return
+        with self.lock:
+            if id(track) not in self.tracks:
+                self.tracks[id(track)] = (track, track.nbytes())
+                self.bytes += self.tracks[id(track)][1]
+            while self.bytes > self.max_bytes and len(self.tracks) > 1:
+                key, (oldest, size) = self.tracks.popitem(last=False)
+                self.bytes -= size
+                oldest.evict()
+                self.evictions += 1
+
+    def touch(self, track: CompactTrajectory):
+        if id(track) in self.tracks:
+            with self.lock:
+                if id(track) in self.tracks:
+                    self.tracks.move_to_end(id(track))
+
+    def stats(self) -> dict:
+        return {"evictable_bytes": self.bytes, "evictions": self.evictions, "reloads": self.reloads}
+
+
+trajectory_store = TrajectoryStore()
@@ -1,55 +1,24 @@
 import math
-import random
-import sys
+import numpy as np
 import matplotlib.pyplot as pl
 import matplotlib.patches as patches
 import matplotlib as mpl
+import geometry
+from rng import rng
 
 def random_rectangle(center_x, center_y, radius, eps=0.1):
     """Create random rectangle (x, y, l, w, r) inside a given circle."""
     min_length = eps * radius
     max_length = (1 - eps) * radius
-    length = random.uniform(min_length, max_length) # half length, since radius is half diameter
+    length = rng().uniform(min_length, max_length) # half length, since radius is half diameter
     width = math.sqrt(radius ** 2 - length ** 2) # half width, since radius is half diameter
-    rotation = random.uniform(0, 90) # in degrees
+    rotation = rng().uniform(0, 90) # in degrees
     scalar = 0.999 # make it a bit smaller, as we discussed
     return (center_x, center_y, scalar * length * 2, scalar * width * 2, rotation)
 
 def get_subrectangles(x, y, l, w, r, count=4):
     """Subdivide the rectangle in x and y direction count times"""
-    r_radian = math.pi * r / 180
-    x1 = x - l / 2
-    x2 = x + l / 2
-    xmin = min([x1, x2])
-    xmax = max([x1, x2])
-    xdiff = xmax - xmin
-
-    y1 = y - w / 2
-    y2 = y + w / 2
-    ymin = min([y1, y2])
-    ymax = max([y1, y2])
-    ydiff = ymax - ymin
-
-    rectangles = []
-    for i in range(count):
-        for j in range(count):
-            rxmin = xmin + i * xdiff / count
-            rx = rxmin + xdiff / (2 * count)
-            rymin = ymin + j * ydiff / count
-            ry = rymin + (ydiff / (2 * count))
-            rl = l / count
-            rw = w / count
-
-            dx = rx - x
-            dy = ry - y
-
-            # Rotation matrix c, -s; s, c
-            newdx = math.cos(r_radian) * dx - math.sin(r_radian) * dy
-            newdy = math.sin(r_radian) * dx + math.cos(r_radian) * dy
-
-            rectangles.append((x + newdx, y + newdy, rl, rw, r))
-
-    return rectangles
+    return [tuple(rectangle) for rectangle in geometry.subrectangles((x, y, l, w, r), count).tolist()]
 
 
 def single_circle_coverage(x, y, l, w, r):
@@ -62,39 +31,31 @@ def circle_coverage(x, y, l, w, r, subdivision_count=4):
     """Create subdivision_count^2 number of circles (center_x, center_y, radius)
     that together encompass a given rectangle (x, y, l, w, r) with r in
     degrees indicating counterclockwise rotation"""
-
-    circles = []
-    for subrectangle in get_subrectangles(x, y, l, w, r, subdivision_count):
-        circles.append(single_circle_coverage(*subrectangle))
-
-    return circles
+    return [tuple(circle) for circle in geometry.circle_coverage((x, y, l, w, r), subdivision_count).tolist()]
 
 def random_nonintersecting_circle(center_x, center_y, upper_b, lower_b, left_b, right_b, other_circles):
     """Given other_circles (as a list of (cx, cy, radius)), find the largest circle
     that does not intersect with other circles"""
-    radius = sys.float_info.max
-    for (other_x, other_y, other_radius) in other_circles:
-        distance = math.sqrt((other_x - center_x)**2 + (other_y - center_y)**2)
-        boundary_distance = get_boundary_distance(center_x, center_y, upper_b, lower_b, left_b, right_b)
-        radius = min([radius, distance - other_radius, boundary_distance])
+    radius = get_boundary_distance(center_x, center_y, upper_b, lower_b, left_b, right_b)
+    if len(other_circles) != 0:
+        circles = np.asarray(other_circles, dtype=float)
+        distances = np.hypot(circles[:, 0] - center_x, circles[:, 1] - center_y) - circles[:, 2]
+        radius = min(radius, float(distances.min()))
     if radius <= 0:
         return None
     else:
-        coeff = random.uniform(0.5, 0.9)
+        coeff = rng().uniform(0.5, 0.9)
         return center_x, center_y, coeff * radius
 
 def random_nonintersecting_rectangle(center_x, center_y, upper_b, lower_b, left_b, right_b, other_rectangles, subdivision_count=4):
     """Given other_rectangles (as a list of (x, y, l, w, r)), return a random rectangle
     inside the largest circle that does not intersect with the circles that cover the other rectangles."""
-    all_other_circles = []
-    print(other_rectangles)
-    for other_rectangle in other_rectangles:
-        all_other_circles += circle_coverage(*other_rectangle, subdivision_count)
-    circle = random_nonintersecting_circle(center_x, center_y, upper_b, lower_b, left_b, right_b, all_other_circles)
-    if circle is not None:
-        return random_rectangle(*circle)
-    else:
+    radius = float(geometry.free_radii((center_x, center_y), (upper_b, lower_b, left_b, right_b), other_rectangles,
+                                       exact=False, subdivision_count=subdivision_count)[0])
+    if radius <= 0:
         return None
+    coeff = rng().uniform(0.5, 0.9)
+    return random_rectangle(center_x, center_y, coeff * radius)
 
 def get_boundary_distance(center_x, center_y, upper_b, lower_b, left_b, right_b):
     upper_distance = upper_b - center_y